@@ -30,7 +30,6 @@ from pca4cd.utils import extralibs
 def check_dependencies() -> bool:
     """Return True if all required extra libraries are importable."""
     try:
-        import dask  # noqa: F401
         import pyqtgraph  # noqa: F401
 
         return True
@@ -0,0 +1,249 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import ast
+import re
+
+import numpy as np
+
+from pca4cd.core.block_io import StackReader
+
+# the bands in the expressions: A3 is the band 3 of A, B3 the band 3 of B
+BAND_NAME = re.compile(r"^([AB])([1-9]\d*)$")
+BINARY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+}
+UNARY_OPERATORS = {ast.USub: np.negative, ast.UAdd: np.positive}
+FUNCTIONS = {
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "log": np.log,
+    "exp": np.exp,
+    "minimum": np.minimum,
+    "maximum": np.maximum,
+}
+
+
+def parse_expression(expression):
+    """Parse a band-math expression, only the bands, the numbers, the
+    arithmetic operators and the FUNCTIONS are allowed (nothing is executed)
+
+    :return: root node of the expression and the set of bands used, as
+        ("A" or "B", band number) pairs
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        raise ValueError(f"Invalid expression: {expression}") from None
+    bands = set()
+
+    def check(node):
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            check(node.left)
+            check(node.right)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            check(node.operand)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError(f"Unknown function in the expression: {ast.unparse(node.func)}")
+            for arg in node.args:
+                check(arg)
+        elif isinstance(node, ast.Name):
+            match = BAND_NAME.match(node.id)
+            if match is None:
+                raise ValueError(f"Unknown band in the expression: {node.id} (use A1, A2, ..., B1, ...)")
+            bands.add((match.group(1), int(match.group(2))))
+        elif isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            pass
+        else:
+            raise ValueError(f"Not allowed in the expression: {ast.unparse(node)}")
+
+    check(tree.body)
+    return tree.body, bands
+
+
+def parse_band_math(text):
+    """Expressions written as "name = expression" separated by ";"
+
+    :return: dict with the name and the expression of each one
+    """
+    expressions = {}
+    for item in text.split(";"):
+        if not item.strip():
+            continue
+        name, sep, expression = item.partition("=")
+        name = name.strip()
+        if not sep or not name or not expression.strip():
+            raise ValueError(f"Write the expressions as name = expression: {item.strip()}")
+        if name in expressions:
+            raise ValueError(f"Repeated name of the expressions: {name}")
+        parse_expression(expression)
+        expressions[name] = expression.strip()
+    return expressions
+
+
+def rename_bands(expression, source, target):
+    """Expression with the bands of the source ("A" or "B") named as the bands
+    of the target, e.g. for the expressions of B applied to an image alone (A)
+    """
+    return re.sub(rf"\b{source}([1-9]\d*)\b", rf"{target}\1", expression)
+
+
+def evaluate(node, bands):
+    """Value of the expression with the bands (dict of the band name and its array)"""
+    if isinstance(node, ast.BinOp):
+        return BINARY_OPERATORS[type(node.op)](evaluate(node.left, bands), evaluate(node.right, bands))
+    if isinstance(node, ast.UnaryOp):
+        return UNARY_OPERATORS[type(node.op)](evaluate(node.operand, bands))
+    if isinstance(node, ast.Call):
+        return FUNCTIONS[node.func.id](*[evaluate(arg, bands) for arg in node.args])
+    if isinstance(node, ast.Name):
+        return bands[node.id]
+    return node.value
+
+
+class BandMath:
+    """Band-math expressions over the bands of A and B (spectral indices),
+    evaluated per block as extra variables of the PCA without writing them
+
+    The bands used by the expressions are read with the bands selected, even
+    if they are not selected.
+    """
+
+    def __init__(self, expressions, n_bands_A):
+        """
+        :param expressions: dict with the name and the expression of each
+            variable (see parse_band_math)
+        :param n_bands_A: number of bands of the raster A, the band n of B is
+            the band n_bands_A + n in the stack
+        """
+        self.names = list(expressions)
+        self.expressions = dict(expressions)
+        self.n_bands_A = n_bands_A
+        self.nodes, self.references = [], []
+        for expression in expressions.values():
+            node, bands = parse_expression(expression)
+            self.nodes.append(node)
+            self.references.append(bands)
+        self.rows = None
+
+    def stack_number(self, band):
+        """Number in the stack of A and B of the ("A" or "B", number) band"""
+        source, number = band
+        return number if source == "A" else self.n_bands_A + number
+
+    def read_band_list(self, band_list, n_stack):
+        """Band numbers of the stack to read: the selected ones (all if None)
+        and the ones used by the expressions
+        """
+        n_bands = {"A": self.n_bands_A, "B": n_stack - self.n_bands_A}
+        for bands in self.references:
+            for source, number in bands:
+                if number > n_bands[source]:
+                    raise ValueError(f"The band {source}{number} of the expressions is not in the layer {source}")
+        used = {self.stack_number(band) for bands in self.references for band in bands}
+        return sorted(set(self.selected_bands(band_list, n_stack)) | used)
+
+    @staticmethod
+    def selected_bands(band_list, n_stack):
+        return list(range(1, n_stack + 1)) if band_list is None else sorted(set(band_list))
+
+    def bind(self, reader, band_list):
+        """Set the rows of the bands in the blocks of the reader (opened with
+        read_band_list) and the bands selected in them
+        """
+        n_stack = sum(src_ds.RasterCount for src_ds in reader.datasets)
+        read_band_list = self.read_band_list(band_list, n_stack)
+        self.rows = {number: row for row, number in enumerate(read_band_list)}
+        selected = self.selected_bands(band_list, n_stack)
+        # rows, number of bands of each input and labels of the bands selected
+        self.selected = np.array([self.rows[number] for number in selected], dtype=int)
+        self.input_bands = [sum(number <= self.n_bands_A for number in selected)]
+        if len(reader.datasets) > 1:
+            self.input_bands.append(len(selected) - self.input_bands[0])
+        self.band_labels = [reader.band_labels[row] for row in self.selected]
+
+    def inputs(self, idx):
+        """Inputs ("A", "B") used by the expression idx"""
+        return {source for source, _ in self.references[idx]}
+
+    def evaluate(self, data):
+        """Variables of the expressions for the block of the bands read
+
+        :param data: block with shape (bands read, rows, cols)
+        :return: new block with shape (n_expressions, rows, cols) and the mask
+            of the pixels without a finite value in any of them or None
+        """
+        values = np.empty((len(self.nodes), *data.shape[1:]), dtype=np.float32)
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            for idx, (node, bands) in enumerate(zip(self.nodes, self.references, strict=True)):
+                band_values = {
+                    f"{source}{number}": data[self.rows[self.stack_number((source, number))]].astype(np.float64)
+                    for source, number in bands
+                }
+                values[idx] = evaluate(node, band_values)
+        invalid = ~np.isfinite(values).all(axis=0)
+        return values, invalid if invalid.any() else None
+
+
+def open_stack(A, B=None, band_list=None, expressions=None):
+    """StackReader of the bands selected and the ones used by the expressions
+
+    :param expressions: band-math expressions (see parse_band_math) or None
+    :return: the reader and the BandMath bound to it, or None without expressions
+    """
+    if not expressions:
+        return StackReader(A, B, band_list), None
+    reader = StackReader(A, B)
+    band_math = BandMath(expressions, reader.datasets[0].RasterCount)
+    read_band_list = band_math.read_band_list(band_list, sum(src_ds.RasterCount for src_ds in reader.datasets))
+    reader.close()
+    reader = StackReader(A, B, read_band_list)
+    band_math.bind(reader, band_list)
+    return reader, band_math
+
+
+def stack_variables(reader, band_math=None, derived_input=None):
+    """Variables of the PCA from the stack: the bands selected or the derived
+    ones (see DERIVED_INPUTS) and then the expressions
+
+    :param reader: StackReader of the stack, see open_stack()
+    :param band_math: BandMath bound to the reader or None
+    :param derived_input: derived variables of A and B or None
+    :return: number of bands of A selected, number of variables and their labels
+    """
+    input_bands = reader.input_bands if band_math is None else band_math.input_bands
+    band_labels = reader.band_labels if band_math is None else band_math.band_labels
+    n_bands_A = input_bands[0]
+    n_bands = sum(input_bands)
+    if derived_input:
+        if len(input_bands) < 2 or n_bands != 2 * n_bands_A:
+            raise ValueError(f"The {derived_input.lower()} input requires B with the same number of bands as A")
+        n_bands = n_bands_A
+        # the numbers of the bands of A selected, the labels of A are "A·Bn"
+        band_labels = [f"{derived_input}·{label.partition('·')[2]}" for label in band_labels[:n_bands_A]]
+    if band_math is not None:
+        n_bands += len(band_math.names)
+        band_labels = band_labels + band_math.names
+    return n_bands_A, n_bands, band_labels
@@ -0,0 +1,705 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import queue
+from pathlib import Path
+
+import numpy as np
+from osgeo import gdal, gdal_array
+
+from pca4cd.core.gdal_profile import gdal_config_options
+
+# storage of the components: (GDAL data type, creation options)
+OUTPUT_PRECISIONS = {
+    "Float32": (gdal.GDT_Float32, []),
+    # scaled integers, the scale of each component is set in the file
+    "Int16": (gdal.GDT_Int16, []),
+    # half floats in the GeoTIFF, read as Float32
+    "Float16": (gdal.GDT_Float32, ["NBITS=16"]),
+}
+# range of the Int16 components in standard deviations of each component
+INT16_RANGE_STD = 10
+INT16_NODATA = -32768
+FLOAT16_MAX = 65504
+# histogram stored in the components: bins over the range of HISTOGRAM_RANGE_STD
+# standard deviations around the mean, the values beyond are in the edge bins
+HISTOGRAM_BINS = 1024
+HISTOGRAM_RANGE_STD = 8
+
+
+def block_windows(x_size, y_size, block_size):
+    """Split the raster in full-width windows of about block_size**2 pixels
+
+    Full-width windows keep the reads and the writes aligned with the
+    strips of the GeoTIFF files, so each strip is written only once.
+
+    :return: list of (xoff, yoff, xsize, ysize) windows in row order
+    """
+    rows = max(1, (block_size**2) // x_size)
+    return [(0, yoff, x_size, min(rows, y_size - yoff)) for yoff in range(0, y_size, rows)]
+
+
+def nodata_mask(data, nodata):
+    """Boolean mask of the pixels with nodata in any band of the block
+
+    :param data: block with shape (bands, rows, cols)
+    :param nodata: nodata value or None
+    :return: mask with shape (rows, cols) or None if there is no nodata
+    """
+    if nodata is None:
+        return None
+    if np.isnan(nodata):
+        return np.isnan(data).any(axis=0)
+    return (data == nodata).any(axis=0)
+
+
+# variables derived per block from the bands of A and B, instead of the stacked bands
+DERIVED_INPUTS = {
+    "Difference": lambda band_A, band_B: band_B - band_A,
+    "Ratio": lambda band_A, band_B: band_B / band_A,
+}
+
+
+def derive_block(data, derived_input, n_bands_A):
+    """Band-wise derived variables of the block of the stack A, B
+
+    :param data: block of the stack with shape (2*n_bands_A, rows, cols)
+    :param derived_input: name of the derivation in DERIVED_INPUTS
+    :param n_bands_A: number of bands of A (and B)
+    :return: new block with shape (n_bands_A, rows, cols) and the mask of the
+        pixels without a finite value in any band (ratios by zero) or None
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        derived = DERIVED_INPUTS[derived_input](data[:n_bands_A], data[n_bands_A:])
+    invalid = ~np.isfinite(derived).all(axis=0)
+    return derived, invalid if invalid.any() else None
+
+
+def block_variables(data, nodata, derived_input=None, n_bands_A=None, band_math=None):
+    """Variables of the PCA in a block of the stack: the bands selected or the
+    derived ones, and the band-math expressions (see core.band_math)
+
+    :param data: block of the stack with shape (bands read, rows, cols)
+    :param derived_input: derived variables of the block (see DERIVED_INPUTS) or None
+    :param n_bands_A: number of bands of A selected, for the derived variables
+    :param band_math: BandMath of the expressions bound to the bands read or None
+    :return: variables with shape (n_variables, rows, cols), the block itself
+        without derived variables nor expressions, and the mask of the pixels
+        with nodata or without a finite value (or None)
+    """
+    mask = nodata_mask(data, nodata)
+    variables = data if band_math is None else data[band_math.selected]
+    if derived_input:
+        variables, invalid = derive_block(variables, derived_input, n_bands_A)
+        if invalid is not None:
+            mask = invalid if mask is None else mask | invalid
+    if band_math is not None:
+        values, invalid = band_math.evaluate(data)
+        variables = np.concatenate([variables, values])
+        if invalid is not None:
+            mask = invalid if mask is None else mask | invalid
+    return variables, mask
+
+
+def same_value(value, nodata):
+    """Compare with the nodata value, also when both are nan"""
+    return value == nodata or (np.isnan(value) and np.isnan(nodata))
+
+
+def band_fill_value(band):
+    """Value that GDAL reads in the empty (sparse) blocks of the band"""
+    fill_value = band.GetNoDataValue()
+    return 0 if fill_value is None else fill_value
+
+
+def pixel_interleaved(src_ds):
+    """True if the bands of the file are stored interleaved by pixel, each
+    block holds all the bands and reading it band by band decodes it once
+    per band
+    """
+    return src_ds.RasterCount > 1 and src_ds.GetMetadataItem("INTERLEAVE", "IMAGE_STRUCTURE") == "PIXEL"
+
+
+def memmap_band(src_ds, band_number=1):
+    """Zero-copy np.memmap view (rows, cols) of the band when the file is an
+    uncompressed GeoTIFF with the strips of the band stored contiguously
+
+    The pages are read (and cached) by the OS on demand, without decoding
+    through GDAL nor copying the band into a new array.
+
+    :return: np.memmap read-only view or None if the layout is not supported
+    """
+    file_path = Path(src_ds.GetDescription())
+    if src_ds.GetDriver().ShortName != "GTiff" or not file_path.is_file():
+        return None
+    if src_ds.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE") is not None:
+        return None
+    band = src_ds.GetRasterBand(band_number)
+    if band.GetMetadataItem("NBITS", "IMAGE_STRUCTURE") is not None:
+        return None
+    x_size, y_size = src_ds.RasterXSize, src_ds.RasterYSize
+    block_x, block_y = band.GetBlockSize()
+    if block_x != x_size:  # tiled
+        return None
+
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    with open(file_path, "rb") as tiff:
+        byte_order = tiff.read(2)
+    dtype = dtype.newbyteorder("<" if byte_order == b"II" else ">")
+
+    interleaved = pixel_interleaved(src_ds)
+    samples = src_ds.RasterCount if interleaved else 1
+    strip_bytes = block_x * block_y * samples * dtype.itemsize
+
+    # all the strips must follow one after the other in the file
+    offsets = [band.GetMetadataItem(f"BLOCK_OFFSET_0_{strip}", "TIFF") for strip in range(-(-y_size // block_y))]
+    if None in offsets:
+        return None
+    offsets = [int(offset) for offset in offsets]
+    if offsets[0] == 0 or any(offset != offsets[0] + k * strip_bytes for k, offset in enumerate(offsets)):
+        return None
+
+    if interleaved:
+        stack = np.memmap(file_path, dtype=dtype, mode="r", offset=offsets[0], shape=(y_size, x_size, samples))
+        return stack[:, :, band_number - 1]
+    return np.memmap(file_path, dtype=dtype, mode="r", offset=offsets[0], shape=(y_size, x_size))
+
+
+def scaled_values(data, band):
+    """Values of the data stored in the band with a scale and offset (the
+    Int16 components), as float32 with nan in the nodata pixels, the data
+    of the bands without scale is returned as is
+    """
+    scale, offset = band.GetScale(), band.GetOffset()
+    if scale in [None, 1] and offset in [None, 0]:
+        return data
+    values = data.astype(np.float32) * (scale or 1) + (offset or 0)
+    if band.GetNoDataValue() is not None:
+        values[data == band.GetNoDataValue()] = np.nan
+    return values
+
+
+def read_band(src_ds, band_number=1):
+    """The whole band as array, a zero-copy memory map when the file layout
+    allows it (see memmap_band) or read through GDAL otherwise, the scaled
+    bands are returned with their values (see scaled_values)
+    """
+    data = memmap_band(src_ds, band_number)
+    if data is None:
+        data = src_ds.GetRasterBand(band_number).ReadAsArray()
+    return scaled_values(data, src_ds.GetRasterBand(band_number))
+
+
+class BlockBuffers:
+    """Pool of preallocated block buffers reused by all the blocks of a pass
+
+    The reader fills a free buffer in place and the consumer gives it back
+    with release() as soon as it is done with the block, so the pass only
+    allocates as many buffers as blocks are alive in the pipeline (that
+    already bounds them, then the pool never blocks).
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.free = queue.SimpleQueue()
+
+    def acquire(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return np.empty(self.shape, dtype=np.float32)
+
+    def release(self, data):
+        """Give back the buffer of the block (the block can be a view of it)"""
+        self.free.put(data if data.base is None else data.base)
+
+
+class StackReader:
+    """Windowed reader of the stack A, or the stacks A and B, as a single
+    list of bands (the variables of the PCA)
+
+    The read strategy is chosen per input from the file layout: memory maps
+    for uncompressed contiguous files, one dataset-level read per window for
+    pixel-interleaved files (each block is decoded once for all the bands)
+    and band by band reads otherwise.
+
+    The GDAL handles are not thread safe, all the reads of one reader must
+    be done in the same thread (the reader stage of the pipeline).
+    """
+
+    def __init__(self, A, B=None, band_list=None):
+        """
+        :param A: first input raster data
+        :param B: second input raster data or None
+        :param band_list: band numbers (starting at 1) in the stack of A and B
+            to read, the bands of A first and then the ones of B, all by default
+        """
+        self.datasets = [gdal.Open(str(A), gdal.GA_ReadOnly)]
+        if B:
+            self.datasets.append(gdal.Open(str(B), gdal.GA_ReadOnly))
+        n_stack_bands = sum(src_ds.RasterCount for src_ds in self.datasets)
+        if band_list is not None and (
+            not band_list or any(not 1 <= band_number <= n_stack_bands for band_number in band_list)
+        ):
+            raise ValueError(f"The band list must select bands between 1 and {n_stack_bands}")
+
+        self.bands = []
+        self.band_labels = []
+        # memory maps of the bands stored uncompressed and contiguous
+        self.memmaps = []
+        # (dataset, first band index in the stack, band list) read in one call per window
+        self.interleaved_reads = []
+        # (band index in the stack, band, memmap) read one by one
+        self.band_reads = []
+        # number of the bands selected of each input
+        self.input_bands = []
+        offset = 0
+        for stack, src_ds in zip("AB", self.datasets, strict=False):
+            input_band_list = [
+                band for band in range(1, src_ds.RasterCount + 1) if band_list is None or offset + band in band_list
+            ]
+            offset += src_ds.RasterCount
+            self.input_bands.append(len(input_band_list))
+            memmaps = [memmap_band(src_ds, band) for band in input_band_list]
+            interleaved = pixel_interleaved(src_ds) and any(memmap is None for memmap in memmaps)
+            if interleaved:
+                self.interleaved_reads.append((src_ds, len(self.bands), input_band_list))
+                memmaps = [None] * len(input_band_list)
+            for band, memmap in zip(input_band_list, memmaps, strict=True):
+                if not interleaved:
+                    self.band_reads.append((len(self.bands), src_ds.GetRasterBand(band), memmap))
+                self.bands.append(src_ds.GetRasterBand(band))
+                self.memmaps.append(memmap)
+                self.band_labels.append(f"{stack}·B{band}" if B else f"B{band}")
+
+        # staging store filled while the blocks are read (see stage)
+        self.staged = None
+
+        ref_ds = self.datasets[0]
+        self.x_size = ref_ds.RasterXSize
+        self.y_size = ref_ds.RasterYSize
+        self.geotransform = ref_ds.GetGeoTransform()
+        self.projection = ref_ds.GetProjection()
+
+    @property
+    def n_bands(self):
+        return len(self.bands)
+
+    def block_shape(self, block_size):
+        """Shape (bands, rows, cols) of the biggest block"""
+        _, _, xsize, ysize = block_windows(self.x_size, self.y_size, block_size)[0]
+        return self.n_bands, ysize, xsize
+
+    def block_bytes(self, block_size):
+        """Bytes of one block of all the bands as float32"""
+        return int(np.prod(self.block_shape(block_size))) * 4
+
+    def cache_row_bytes(self):
+        """Bytes of one row of GDAL blocks of all the bands, the GDAL block
+        cache should hold it to decode each block only once
+        """
+        row_bytes = 0
+        for band in self.bands:
+            block_x, block_y = band.GetBlockSize()
+            n_blocks_x = -(-self.x_size // block_x)
+            row_bytes += n_blocks_x * block_x * block_y * gdal.GetDataTypeSize(band.DataType) // 8
+        return row_bytes
+
+    def stage(self, staged):
+        """Copy the blocks into the staging store while they are read, once it
+        is complete all the next reads come from it instead of the inputs
+
+        :param staged: StagedStack with the shape of the stack
+        """
+        self.staged = staged
+        if staged.complete:
+            self.read_from_stack(staged.stack)
+
+    def read_from_stack(self, stack):
+        """Read all the bands from the stack array with shape (bands, rows, cols)"""
+        self.memmaps = list(stack)
+        self.interleaved_reads = []
+        self.band_reads = [
+            (idx, band, memmap) for idx, (band, memmap) in enumerate(zip(self.bands, self.memmaps, strict=True))
+        ]
+
+    def empty_window(self, window, nodata):
+        """True if all the pixels of the window are nodata without reading it
+
+        GDAL reports the window as empty when it only covers sparse blocks
+        (never written, without offset in the file), those read as the fill
+        value of the band, if it is the nodata value all the pixels of the
+        window are masked (nodata in any band).
+        """
+        if nodata is None:
+            return False
+        xoff, yoff, xsize, ysize = window
+        for band in self.bands:
+            if not same_value(band_fill_value(band), nodata):
+                continue
+            flags, _ = band.GetDataCoverageStatus(xoff, yoff, xsize, ysize)
+            if flags == gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY:
+                return True
+        return False
+
+    def read(self, window, out=None):
+        """Read all the bands of the window as float32 with shape (bands, rows, cols)
+
+        :param out: buffer to fill in place, GDAL converts the data type directly
+            into it, without intermediate arrays
+        """
+        xoff, yoff, xsize, ysize = window
+        data = np.empty((self.n_bands, ysize, xsize), dtype=np.float32) if out is None else out
+        for src_ds, start, band_list in self.interleaved_reads:
+            src_ds.ReadAsArray(
+                xoff, yoff, xsize, ysize, buf_obj=data[start : start + len(band_list)], band_list=band_list
+            )
+        for idx, band, memmap in self.band_reads:
+            if memmap is not None:
+                data[idx] = memmap[yoff : yoff + ysize, xoff : xoff + xsize]
+            else:
+                band.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=data[idx])
+        return data
+
+    def blocks(self, block_size, buffers=None, nodata=None, skip=None):
+        """Generator of (window, data) for all the blocks of the stack
+
+        :param buffers: BlockBuffers to fill in place, each data is a view of
+            one of its buffers and must be released by the consumer
+        :param nodata: nodata value, the windows with only nodata pixels are
+            not read and their data is None (see empty_window)
+        :param skip: function skip(window) called in the reader thread, if it
+            returns True the data of the window is None too (the empty and the
+            skipped windows are still read while the staging store is filled)
+        """
+        staging = self.staged is not None and not self.staged.complete
+        for window in block_windows(self.x_size, self.y_size, block_size):
+            _, _, xsize, ysize = window
+            # the empty windows are read too while the staging store is filled,
+            # the other bands can have data there and the store is reused by
+            # the runs with other nodata
+            skipped = self.empty_window(window, nodata) or (skip is not None and skip(window))
+            if skipped and not staging:
+                yield window, None
+                continue
+            out = None if buffers is None else buffers.acquire()[:, :ysize, :xsize]
+            data = self.read(window, out)
+            if staging:
+                self.staged.write(window, data)
+            if skipped:
+                if buffers is not None:
+                    buffers.release(data)
+                yield window, None
+                continue
+            yield window, data
+        if staging:
+            self.staged.set_complete()
+            self.read_from_stack(self.staged.stack)
+
+    def close(self):
+        self.bands = []
+        self.memmaps = []
+        self.interleaved_reads = []
+        self.band_reads = []
+        self.staged = None
+        self.datasets = []
+
+
+class WeightReader:
+    """Windowed reader of the weight raster of the pixels (a per-pixel
+    confidence or a 0/1 mask), its nodata, nan and negative values are read
+    as weight 0 (excluded)
+    """
+
+    def __init__(self, weights, reference):
+        """
+        :param weights: weight raster, the first band is used
+        :param reference: StackReader of the inputs, with the same size
+        """
+        self.dataset = gdal.Open(str(weights), gdal.GA_ReadOnly)
+        if (self.dataset.RasterXSize, self.dataset.RasterYSize) != (reference.x_size, reference.y_size):
+            raise ValueError("The weight raster doesn't have the same dimensions (columns/rows) as the inputs")
+        self.band = self.dataset.GetRasterBand(1)
+        self.nodata = self.band.GetNoDataValue()
+
+    def read(self, window):
+        """Weights of the window with shape (rows, cols)"""
+        xoff, yoff, xsize, ysize = window
+        weights = self.band.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float64)
+        excluded = ~np.isfinite(weights) | (weights < 0)
+        if self.nodata is not None:
+            excluded |= weights == self.nodata
+        weights[excluded] = 0
+        return weights
+
+    def close(self):
+        self.band = None
+        self.dataset = None
+
+
+class ComponentStatistics:
+    """Min, max, mean, standard deviation and histogram of a component,
+    accumulated with the valid values of each block written
+    """
+
+    def __init__(self, std=None):
+        """
+        :param std: expected standard deviation of the component to set the
+            range of the histogram, the one of the first block if None
+        """
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.expected_std = std
+        self.range = None
+        self.counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+
+    def update(self, values):
+        """Merge the valid values of a block (flat array)"""
+        if values.size == 0:
+            return
+        count = values.size
+        mean = values.mean(dtype=np.float64)
+        m2 = values.var(dtype=np.float64) * count
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        if self.range is None:
+            # centered in the first block, the components have a stable mean
+            spread = HISTOGRAM_RANGE_STD * (self.expected_std or np.sqrt(m2 / count))
+            spread = spread or max(abs(mean), 1.0)
+            self.range = (mean - spread, mean + spread)
+        low, high = self.range
+        bins = ((values - low) * (HISTOGRAM_BINS / (high - low))).astype(np.int64)
+        np.clip(bins, 0, HISTOGRAM_BINS - 1, out=bins)
+        self.counts += np.bincount(bins, minlength=HISTOGRAM_BINS)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count else 0.0
+
+    def store(self, band, scale=None):
+        """Set the statistics and the default histogram in the band (saved in
+        the file or its .aux.xml), in the stored values of the scaled bands
+        """
+        if self.count == 0:
+            return
+        scale = scale or 1
+        band.SetStatistics(*(float(value / scale) for value in [self.min, self.max, self.mean, self.std]))
+        band.SetDefaultHistogram(float(self.range[0] / scale), float(self.range[1] / scale), self.counts.tolist())
+
+
+def stored_histogram(band):
+    """Default histogram stored in the band (see ComponentStatistics), in the
+    values of the scaled bands, without reading it
+
+    :return: counts and bin edges (as np.histogram) or None
+    """
+    histogram = band.GetDefaultHistogram(force=False)
+    if histogram is None or sum(histogram[3]) == 0:
+        return None
+    low, high, _, counts = histogram
+    scale, offset = band.GetScale() or 1, band.GetOffset() or 0
+    return np.asarray(counts), np.linspace(low, high, len(counts) + 1) * scale + offset
+
+
+def stored_statistics(band):
+    """Statistics stored in the band (see ComponentStatistics), in the values
+    of the scaled bands, without reading it
+
+    :return: dict with min, max, mean, std and the percentiles p25, p50, p75
+        interpolated in the default histogram (if any), or None
+    """
+    items = [band.GetMetadataItem(f"STATISTICS_{key}") for key in ["MINIMUM", "MAXIMUM", "MEAN", "STDDEV"]]
+    if any(item is None for item in items):
+        return None
+    scale, offset = band.GetScale() or 1, band.GetOffset() or 0
+    minimum, maximum, mean, std = (float(item) for item in items)
+    stats = {
+        "min": minimum * scale + offset,
+        "max": maximum * scale + offset,
+        "mean": mean * scale + offset,
+        "std": std * abs(scale),
+    }
+    histogram = stored_histogram(band)
+    if histogram is not None:
+        counts, edges = histogram
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        for percentile in [25, 50, 75]:
+            stats[f"p{percentile}"] = float(np.interp(percentile / 100 * cumulative[-1], cumulative, edges))
+    return stats
+
+
+class ComponentWriter:
+    """Windowed writer of the principal components, one GeoTIFF per component
+
+    The files are sparse, the blocks never written are not stored and they
+    read as the nodata value. The statistics and the histogram of each
+    component are accumulated while writing and stored when closing (see
+    ComponentStatistics), so they are never computed from the files.
+    """
+
+    def __init__(
+        self,
+        out_dir,
+        n_pc,
+        reference,
+        nodata=None,
+        prefix="pc",
+        precision="Float32",
+        component_std=None,
+        numbers=None,
+        update=False,
+    ):
+        """
+        :param out_dir: directory to save the components
+        :param n_pc: number of components
+        :param reference: StackReader with the size, geotransform and projection to use
+        :param nodata: nodata value to set in the components
+        :param prefix: prefix of the component files
+        :param precision: storage of the components (see OUTPUT_PRECISIONS), the
+            Int16 and Float16 files use their own nodata value (INT16_NODATA, nan),
+            the Int16 files always have it for the values not finite
+        :param component_std: standard deviation of each component, required
+            for Int16 to set the scale that covers INT16_RANGE_STD deviations
+        :param numbers: numbers of the components in the file names, 1 to n_pc by default
+        :param update: open the component files that already exist to write
+            the rest of their blocks (resume a run), instead of creating them
+        """
+        driver = gdal.GetDriverByName("GTiff")
+        data_type, options = OUTPUT_PRECISIONS[precision]
+        self.precision = precision
+        self.nodata = nodata
+        self.scales = None
+        if precision == "Int16":
+            if component_std is None:
+                raise ValueError("The Int16 components require the standard deviation of each component")
+            component_std = np.where(np.asarray(component_std) > 0, component_std, 1)
+            self.scales = INT16_RANGE_STD * component_std / 32767
+        file_nodata = nodata
+        if precision == "Int16":
+            # the pixels without a finite value (invalid ratios or expressions, nan inputs)
+            file_nodata = INT16_NODATA
+        elif nodata is not None and precision != "Float32":
+            file_nodata = np.nan
+        self.files = []
+        self.datasets = []
+        self.bands = []
+        self.statistics = []
+        # components with blocks written by a previous run, their statistics are computed from the file
+        self.resumed = []
+        numbers = range(1, n_pc + 1) if numbers is None else numbers
+        for i, number in enumerate(numbers):
+            tmp_pca_file = Path(out_dir) / f"{prefix}_{number}.tif"
+            self.statistics.append(ComponentStatistics(None if component_std is None else float(component_std[i])))
+            if update and tmp_pca_file.is_file():
+                out_pc = gdal.Open(str(tmp_pca_file), gdal.GA_Update)
+                self.resumed.append(i)
+            else:
+                out_pc = driver.Create(
+                    str(tmp_pca_file), reference.x_size, reference.y_size, 1, data_type, ["SPARSE_OK=TRUE", *options]
+                )
+            # set projection and geotransform
+            if reference.geotransform is not None:
+                out_pc.SetGeoTransform(reference.geotransform)
+            if reference.projection is not None:
+                out_pc.SetProjection(reference.projection)
+            pcband = out_pc.GetRasterBand(1)
+            if file_nodata is not None:
+                pcband.SetNoDataValue(file_nodata)
+            if self.scales is not None:
+                pcband.SetScale(float(self.scales[i]))
+                pcband.SetOffset(0)
+            self.files.append(tmp_pca_file)
+            self.datasets.append(out_pc)
+            self.bands.append(pcband)
+
+    def encode(self, idx, component):
+        """Values of the component to store with the precision of the files"""
+        if self.precision == "Float32":
+            return component
+        invalid = None
+        if self.nodata is not None:
+            invalid = np.isnan(component) if np.isnan(self.nodata) else component == self.nodata
+        if self.precision == "Int16":
+            with np.errstate(invalid="ignore"):
+                values = np.clip(np.rint(component / self.scales[idx]), -32767, 32767).astype(np.int16)
+            # nan has no integer value, it is cast to an arbitrary one
+            not_finite = ~np.isfinite(component)
+            values[not_finite if invalid is None else invalid | not_finite] = INT16_NODATA
+            return values
+        # out of the range of the half floats they would be infinite
+        values = np.clip(component, -FLOAT16_MAX, FLOAT16_MAX)
+        if invalid is not None:
+            values[invalid] = np.nan
+        return values
+
+    def write(self, window, components):
+        """Write the block of components with shape (n_pc, rows, cols) in the window,
+        if components is None the block is left empty (nodata)
+        """
+        if components is None:
+            return
+        xoff, yoff, _, _ = window
+        for idx, (pcband, component) in enumerate(zip(self.bands, components, strict=True)):
+            valid = np.isfinite(component)
+            if self.nodata is not None and not np.isnan(self.nodata):
+                valid &= component != self.nodata
+            self.statistics[idx].update(component[valid])
+            pcband.WriteArray(self.encode(idx, component), xoff, yoff)
+
+    def flush(self):
+        """Write to disk the blocks cached by GDAL"""
+        for out_pc in self.datasets:
+            out_pc.FlushCache()
+
+    def store_statistics(self):
+        for idx, (pcband, statistics) in enumerate(zip(self.bands, self.statistics, strict=True)):
+            if idx in self.resumed:
+                # the blocks of the previous run are not in the statistics
+                self.datasets[idx].FlushCache()
+                pcband.ComputeStatistics(False)
+                low, high, _, counts = pcband.GetDefaultHistogram(force=True)
+                pcband.SetDefaultHistogram(low, high, counts)
+            else:
+                statistics.store(pcband, None if self.scales is None else float(self.scales[idx]))
+
+    def close(self):
+        """Flush and close all the components, return the list of files"""
+        self.store_statistics()
+        self.flush()
+        self.bands = []
+        self.datasets = []
+        return self.files
+
+
+def build_overviews(pca_files):
+    """Compute the pyramids for each component file"""
+    with gdal_config_options({"BIGTIFF_OVERVIEW": "YES"}):
+        for pca_file in pca_files:
+            ds = gdal.Open(str(pca_file), gdal.GA_Update)
+            ds.BuildOverviews("AVERAGE", [2, 4, 8, 16, 32])
+            ds = None
@@ -0,0 +1,137 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from pca4cd.core.moments import Moments
+from pca4cd.core.staging import staging_key
+
+# seconds between the checkpoints of a run
+CHECKPOINT_INTERVAL = 60
+
+
+def checkpoint_key(A, B=None, band_labels=None, **options):
+    """Key of the run for its job directory, it changes if the inputs are
+    modified or with other options (that change the blocks or the results)
+    """
+    key = hashlib.sha1(staging_key(A, B, band_labels).encode())
+    key.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return key.hexdigest()[:16]
+
+
+class Checkpoint:
+    """Durable state of a run in its job directory, to resume it after a crash
+
+    The blocks are full-width windows consumed in row order, the state is the
+    pass of the run ("moments" or "projection"), the rows of the image already
+    done in that pass and the moments accumulated. The state file is replaced
+    atomically, so it is always consistent with the outputs flushed before.
+    The windows done are the ones of the state loaded (the resume point), the
+    next checkpoints do not change them.
+    """
+
+    def __init__(self, job_dir, interval=CHECKPOINT_INTERVAL):
+        """
+        :param job_dir: job directory of the run (see checkpoint_key), kept
+            until the run is complete
+        :param interval: minimum seconds between the checkpoints
+        """
+        self.job_dir = Path(job_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.state_file = self.job_dir / "state.json"
+        self.interval = interval
+        self.last_save = time.monotonic()
+        self.phase, self.rows_done, self.moments = "moments", 0, None
+        # (pass, rows done) of the state loaded
+        self.resumed = (self.phase, self.rows_done)
+        if self.state_file.is_file():
+            with open(self.state_file) as state_file:
+                state = json.load(state_file)
+            self.phase, self.rows_done = state["phase"], state["rows_done"]
+            if state["moments"] is not None:
+                # the moments of the rows done
+                self.moments = Moments(len(state["moments"]["mean"]))
+                self.moments.count = state["moments"]["count"]
+                self.moments.mean = np.asarray(state["moments"]["mean"])
+                self.moments.cross = np.asarray(state["moments"]["cross"])
+            self.resumed = (self.phase, self.rows_done)
+
+    @property
+    def output_dir(self):
+        """Directory of the outputs while the run is not complete"""
+        return self.job_dir / "outputs"
+
+    def done(self, phase, window):
+        """True if the window was done in the pass when the run was resumed"""
+        resumed_phase, resumed_rows = self.resumed
+        if phase == "moments" and resumed_phase == "projection":
+            return True
+        return phase == resumed_phase and window[1] + window[3] <= resumed_rows
+
+    def due(self):
+        return time.monotonic() - self.last_save >= self.interval
+
+    def save(self, phase, rows_done, moments=None):
+        """Save the state, the outputs of the rows done must be flushed before"""
+        # the windows skipped before the resume point are already in the state
+        resumed_phase, resumed_rows = self.resumed
+        if phase == resumed_phase and rows_done < resumed_rows:
+            return
+        state = {"phase": phase, "rows_done": int(rows_done), "moments": None}
+        if moments is not None:
+            state["moments"] = {
+                "count": float(moments.count),
+                "mean": moments.mean.tolist(),
+                "cross": moments.cross.tolist(),
+            }
+        tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+        with open(tmp_file, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_file, self.state_file)
+        self.phase, self.rows_done, self.moments = phase, rows_done, moments
+        self.last_save = time.monotonic()
+
+    def move_outputs(self, files, out_dir):
+        """Move the completed outputs to out_dir, with their sidecar files (the
+        .aux.xml with the statistics stored and the .ovr overviews)
+
+        :return: the files in out_dir
+        """
+        moved = []
+        for file_path in files:
+            target = Path(out_dir) / Path(file_path).name
+            shutil.move(str(file_path), str(target))
+            for suffix in [".aux.xml", ".ovr"]:
+                sidecar = Path(str(file_path) + suffix)
+                if sidecar.is_file():
+                    shutil.move(str(sidecar), str(target) + suffix)
+            moved.append(target)
+        return moved
+
+    def remove(self):
+        """Remove the job directory, when the run is complete (or cannot complete)"""
+        shutil.rmtree(self.job_dir, ignore_errors=True)
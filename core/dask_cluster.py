@@ -0,0 +1,85 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import importlib.util
+import multiprocessing
+from pathlib import Path
+
+# the local cluster of the Dask engine, reused by the next runs with the same settings
+_cluster = None
+_client = None
+_cluster_settings = None
+
+
+def cluster_available():
+    """True if dask.distributed is installed"""
+    return importlib.util.find_spec("distributed") is not None
+
+
+def start_cluster(n_workers, memory_budget, local_directory):
+    """Start (or reuse) the dask.distributed LocalCluster with n_workers
+    processes of one thread, the memory budget split between the workers
+    that spill to disk in local_directory above their limit
+
+    :param memory_budget: memory budget of the run in MB
+    :return: client of the cluster
+    """
+    global _cluster, _client, _cluster_settings
+    from distributed import Client, LocalCluster
+
+    from pca4cd.core.jobs import worker_executable
+
+    settings = (n_workers, memory_budget, str(local_directory))
+    if _client is not None and settings == _cluster_settings:
+        return _client
+    close_cluster()
+    Path(local_directory).mkdir(parents=True, exist_ok=True)
+    # the workers are spawned processes, inside QGIS sys.executable can be the
+    # QGIS application instead of Python (as for the jobs, see run_jobs)
+    multiprocessing.get_context("spawn").set_executable(worker_executable())
+    _cluster = LocalCluster(
+        n_workers=max(1, n_workers),
+        threads_per_worker=1,
+        processes=True,
+        memory_limit=f"{max(1, memory_budget // max(1, n_workers))}MB",
+        local_directory=str(local_directory),
+        # any free port for the dashboard
+        dashboard_address=":0",
+    )
+    _client = Client(_cluster, set_as_default=False)
+    _cluster_settings = settings
+    return _client
+
+
+def dashboard_link():
+    """Address of the diagnostics dashboard of the running cluster, or None"""
+    if _client is None:
+        return None
+    return _client.dashboard_link
+
+
+def close_cluster():
+    """Close the cluster and its workers, if it is running"""
+    global _cluster, _client, _cluster_settings
+    if _client is not None:
+        _client.close()
+    if _cluster is not None:
+        _cluster.close()
+    _cluster = _client = _cluster_settings = None
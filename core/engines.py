@@ -0,0 +1,69 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import importlib
+import importlib.util
+import inspect
+import tempfile
+import time
+
+# name of the engine: (module with the pca function, extra library required)
+PCA_ENGINES = {
+    "NumPy": ("pca4cd.core.pca_numpy_gdal", None),
+    "Dask": ("pca4cd.core.pca_dask_gdal", "dask"),
+    "Jobs": ("pca4cd.core.jobs", None),
+}
+
+
+def available_engines():
+    """Names of the engines with their required libraries installed"""
+    return [
+        name
+        for name, (_, requires) in PCA_ENGINES.items()
+        if requires is None or importlib.util.find_spec(requires) is not None
+    ]
+
+
+def get_pca_engine(name):
+    """The pca function of the engine"""
+    module, _ = PCA_ENGINES[name]
+    return importlib.import_module(module).pca
+
+
+def benchmark_engines(A, B, n_pc, estimator_matrix, n_threads, block_size, nodata=None, repeats=3, engines=None):
+    """Wall time of the available engines computing the same PCA, the best
+    of the repeats for each one (to use from the QGIS Python console)
+
+    :param engines: names of the engines to compare, all available by default
+    :return: dict with the engine name and its time in seconds
+    """
+    timings = {}
+    for name in engines or available_engines():
+        # run without the wait cursor of the dialog
+        pca = inspect.unwrap(get_pca_engine(name))
+        best = None
+        for _ in range(max(1, repeats)):
+            with tempfile.TemporaryDirectory() as out_dir:
+                start = time.perf_counter()
+                pca(A, B, n_pc, estimator_matrix, out_dir, n_threads, block_size, nodata)
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
@@ -0,0 +1,97 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from osgeo import gdal
+
+# name of the profile: fraction of the free memory budget for the GDAL block cache
+GDAL_PROFILES = {
+    "Balanced": 0.4,
+    "Compressed inputs": 0.75,
+    "GDAL defaults": None,
+}
+
+
+class gdal_config_options:
+    """Set GDAL config options inside the context and restore the previous
+    values (or unset them) at the exit
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.previous = {}
+        self.previous_cache_max = None
+
+    def __enter__(self):
+        # GDAL reads GDAL_CACHEMAX only once, the cache is resized directly
+        options = dict(self.options)
+        cache_mb = options.pop("GDAL_CACHEMAX", None)
+        if cache_mb is not None:
+            self.previous_cache_max = gdal.GetCacheMax()
+            gdal.SetCacheMax(int(cache_mb) * 1024**2)
+        for key, value in options.items():
+            self.previous[key] = gdal.GetConfigOption(key)
+            gdal.SetConfigOption(key, value)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for key, previous_value in self.previous.items():
+            gdal.SetConfigOption(key, previous_value)
+        self.previous = {}
+        if self.previous_cache_max is not None:
+            gdal.SetCacheMax(self.previous_cache_max)
+            self.previous_cache_max = None
+
+
+def performance_profile(profile, n_threads, memory_budget, pipeline_bytes, cache_row_bytes=0):
+    """GDAL config options of the profile, sized against the compute threads
+    and the memory budget of the run
+
+    The blocks alive in the pipeline are taken from the budget first, a
+    fraction of the rest goes to the GDAL block cache, but never less than
+    one row of blocks of all the input bands, otherwise each full-width
+    window decodes the same compressed tiles again.
+
+    :param profile: name of the profile in GDAL_PROFILES
+    :param n_threads: number of compute threads of the pipeline
+    :param memory_budget: memory budget for the whole run in MB
+    :param pipeline_bytes: bytes used by the blocks alive in the pipeline
+    :param cache_row_bytes: bytes of one row of blocks of all the input bands
+    :return: dict with the GDAL config options
+    """
+    cache_fraction = GDAL_PROFILES[profile]
+    if cache_fraction is None:
+        return {}
+
+    mb = 1024**2
+    free_mb = max(memory_budget - pipeline_bytes // mb, 0)
+    cache_mb = max(int(free_mb * cache_fraction), -(-cache_row_bytes // mb), 64)
+    # keep the rest of the budget for the VSI cache, up to 25% of the block cache
+    vsi_cache_mb = max(min(free_mb - cache_mb, cache_mb // 4), 16)
+
+    return {
+        # in MB
+        "GDAL_CACHEMAX": str(cache_mb),
+        # decode the compressed blocks of one read in parallel
+        "GDAL_NUM_THREADS": str(max(1, int(n_threads))),
+        "VSI_CACHE": "TRUE",
+        "VSI_CACHE_SIZE": str(vsi_cache_mb * mb),
+        # do not list the folder of the inputs when they are opened
+        "GDAL_DISABLE_READDIR_ON_OPEN": "TRUE",
+    }
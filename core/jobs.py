@@ -0,0 +1,366 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ The PCA as independent tile jobs: each moment job writes the partial
+ moments of its tile in a small file, a merge step solves the eigenproblem
+ and the projection jobs write the components of each tile, assembled at the
+ end in the pc_N.tif files. The jobs are plain dicts saved as JSON files in
+ out_dir/jobs, they run in local worker processes by default or in any other
+ executor (or machine) sharing the filesystem:
+
+     python -m pca4cd.core.jobs out_dir/jobs/moments_1.json ...
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from pca4cd.core.band_math import open_stack, stack_variables
+from pca4cd.core.block_io import (
+    ComponentWriter,
+    StackReader,
+    WeightReader,
+    block_variables,
+    block_windows,
+    build_overviews,
+)
+from pca4cd.core.checkpoint import checkpoint_key
+from pca4cd.core.moments import COMPONENT_RULES, Moments, eigen_decomposition, select_components
+from pca4cd.core.staging import staging_key
+from pca4cd.core.transform import load_transform, project_block, save_transform
+from pca4cd.utils.system_utils import wait_process
+
+
+def tile_windows(tile, block_size):
+    """Full-width windows of about block_size**2 pixels inside the tile"""
+    xoff, yoff, xsize, ysize = tile
+    return [(xoff, yoff + y, xsize, rows) for _, y, _, rows in block_windows(xsize, ysize, block_size)]
+
+
+def moment_job(job):
+    """Partial moments of the variables in the tile of the job, saved in job["output"]"""
+    reader, band_math = open_stack(job["A"], job["B"], job["band_list"], job["expressions"])
+    weight_reader = WeightReader(job["weights"], reader) if job["weights"] else None
+    nodata, derived_input = job["nodata"], job["derived_input"]
+    n_bands_A, n_bands, _ = stack_variables(reader, band_math, derived_input)
+    moments = Moments(n_bands)
+    try:
+        for window in tile_windows(job["window"], job["block_size"]):
+            pixel_weights = None
+            if weight_reader is not None:
+                pixel_weights = weight_reader.read(window)
+                # windows without any weight are not read
+                if not pixel_weights.any():
+                    continue
+                pixel_weights = pixel_weights.ravel()
+            if reader.empty_window(window, nodata):
+                continue
+            data, mask = block_variables(reader.read(window), nodata, derived_input, n_bands_A, band_math)
+            flat_dims = data.reshape((n_bands, -1))
+            if mask is not None:
+                flat_dims = flat_dims[:, ~mask.ravel()]
+                if pixel_weights is not None:
+                    pixel_weights = pixel_weights[~mask.ravel()]
+            moments.merge(Moments.from_block(flat_dims, pixel_weights))
+    finally:
+        if weight_reader is not None:
+            weight_reader.close()
+        reader.close()
+    moments.save(job["output"])
+    return job["output"]
+
+
+def projection_job(job):
+    """Components of the tile of the job with the transform of the merge step,
+    saved in job["output"] as an array (n_pc, rows, cols), the tiles with only
+    nodata are not saved and stay empty in the outputs
+
+    Each window is written to the output file (memory mapped) as soon as it is
+    projected, the worker never holds the components of the whole tile.
+    """
+    transform = load_transform(job["transform"])
+    band_mean = transform["band_mean"]
+    eigenvectors = transform["eigenvectors"][:, : transform["n_components"]]
+    nodata, derived_input = job["nodata"], job["derived_input"]
+    reader, band_math = open_stack(job["A"], job["B"], job["band_list"], job["expressions"])
+    n_bands_A, _, _ = stack_variables(reader, band_math, derived_input)
+    _, yoff, xsize, ysize = job["window"]
+    output = Path(job["output"])
+    tmp_file = output.with_name(output.name + ".tmp")
+    components = None
+    # windows without components, filled with the nodata once the file exists
+    empty_windows = []
+    try:
+        for window in tile_windows(job["window"], job["block_size"]):
+            pc = None
+            if not reader.empty_window(window, nodata):
+                pc = project_block(
+                    reader.read(window), band_mean, eigenvectors, nodata, derived_input, n_bands_A, band_math
+                )
+            if pc is None:
+                empty_windows.append(window)
+                continue
+            if components is None:
+                components = np.lib.format.open_memmap(
+                    tmp_file, mode="w+", dtype=np.float32, shape=(eigenvectors.shape[1], ysize, xsize)
+                )
+            components[:, window[1] - yoff : window[1] - yoff + window[3]] = pc
+    finally:
+        reader.close()
+    if components is None:
+        return None
+    for window in empty_windows:
+        components[:, window[1] - yoff : window[1] - yoff + window[3]] = np.nan if nodata is None else nodata
+    components.flush()
+    del components
+    os.replace(tmp_file, output)
+    return job["output"]
+
+
+JOB_TASKS = {"moments": moment_job, "projection": projection_job}
+
+
+def run_job(job):
+    """Run a job (dict or JSON file) in this process, the jobs with their
+    output already saved (by a previous run) are done
+    """
+    if not isinstance(job, dict):
+        with open(job) as job_file:
+            job = json.load(job_file)
+    if Path(job["output"]).is_file():
+        return job["output"]
+    return JOB_TASKS[job["task"]](job)
+
+
+def worker_executable():
+    """Python interpreter for the worker processes, inside QGIS sys.executable
+    can be the QGIS application instead of Python
+    """
+    if Path(sys.executable).name.lower().startswith("python"):
+        return sys.executable
+    for name in ["pythonw.exe", "python.exe", "bin/python3"]:
+        executable = Path(sys.exec_prefix) / name
+        if executable.is_file():
+            return str(executable)
+    return sys.executable
+
+
+def run_jobs(jobs, n_workers, executor=None):
+    """Run the jobs in the executor, local worker processes by default
+
+    :param executor: object with a map(function, jobs) method that runs the
+        jobs and returns their results (e.g. a concurrent.futures executor
+        over a cluster), the jobs only share the filesystem
+    :return: results of the jobs in order
+    """
+    if executor is not None:
+        return list(executor.map(run_job, jobs))
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(worker_executable())
+    with ProcessPoolExecutor(max_workers=max(1, n_workers), mp_context=context) as pool:
+        return list(pool.map(run_job, jobs))
+
+
+def write_jobs(jobs, jobs_dir, task):
+    """Save the jobs as JSON files, to run them elsewhere with run_job"""
+    for idx, job in enumerate(jobs):
+        with open(Path(jobs_dir) / f"{task}_{idx + 1}.json", "w") as job_file:
+            json.dump(job, job_file, indent=2)
+
+
+@wait_process
+def pca(
+    A,
+    B,
+    n_pc,
+    estimator_matrix,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata=None,
+    tile_size=4096,
+    derived_input=None,
+    band_list=None,
+    weights=None,
+    precision="Float32",
+    variance_threshold=0.95,
+    executor=None,
+    checkpoint_dir=None,
+    expressions=None,
+):
+    """Calculate the principal components with independent tile jobs, the
+    same results of pca() of the NumPy engine
+
+    :param A: first input raster data (fists period)
+    :param B: second input raster data (second period) or None
+    :param n_pc: number of principal components to output or a rule, see pca()
+    :param estimator_matrix: pca with correlation of covariance
+    :param out_dir: directory to save the outputs, shared by all the workers
+    :param n_threads: number of local worker processes
+    :param block_size: blocks of about block_size**2 pixels read by the jobs
+    :param nodata: nodata value of the inputs or None
+    :param tile_size: tiles (jobs) of about tile_size**2 pixels
+    :param derived_input: derived variables of A and B, see pca()
+    :param band_list: band numbers in the stack of A and B to use, see pca()
+    :param weights: weight raster of the moments, see pca()
+    :param precision: storage of the components, see pca()
+    :param variance_threshold: fraction of the variance with the "Cumulative variance" rule
+    :param executor: executor of the jobs instead of the local processes, see run_jobs()
+    :param checkpoint_dir: durable directory for the job directory of the run
+        (see checkpoint_key) instead of out_dir, running it again with the same
+        inputs and options resumes it, only the jobs not done are run
+    :param expressions: band-math expressions of extra variables, see pca()
+    :return: pca files list and statistics
+    """
+    reader, band_math = open_stack(A, B, band_list, expressions)
+    try:
+        _, n_bands, band_labels = stack_variables(reader, band_math, derived_input)
+    except ValueError:
+        reader.close()
+        raise
+    tiles = block_windows(reader.x_size, reader.y_size, tile_size)
+    reader.close()
+
+    jobs_dir = Path(out_dir) / "jobs"
+    if checkpoint_dir:
+        run_key = checkpoint_key(
+            A,
+            B,
+            reader.band_labels,
+            n_pc=n_pc,
+            estimator_matrix=estimator_matrix,
+            block_size=block_size,
+            nodata=nodata,
+            tile_size=tile_size,
+            derived_input=derived_input,
+            weights=staging_key(weights) if weights else None,
+            variance_threshold=variance_threshold,
+            expressions=expressions,
+        )
+        jobs_dir = Path(checkpoint_dir) / run_key
+    else:
+        # the outputs found are taken as jobs done, only a checkpoint is resumed
+        shutil.rmtree(jobs_dir, ignore_errors=True)
+    jobs_dir.mkdir(parents=True, exist_ok=True)
+    inputs = {
+        "A": str(A),
+        "B": str(B) if B else None,
+        "band_list": list(band_list) if band_list else None,
+        "nodata": nodata,
+        "derived_input": derived_input,
+        "expressions": expressions or None,
+        "block_size": block_size,
+    }
+
+    ########
+    # moment jobs and merge of the partial moments
+
+    moment_jobs = [
+        dict(
+            inputs,
+            task="moments",
+            window=list(tile),
+            weights=str(weights) if weights else None,
+            output=str(jobs_dir / f"moments_{idx + 1}.npz"),
+        )
+        for idx, tile in enumerate(tiles)
+    ]
+    write_jobs(moment_jobs, jobs_dir, "moments")
+    moments = Moments(n_bands)
+    for partial_file in run_jobs(moment_jobs, n_threads, executor):
+        moments.merge(Moments.load(partial_file))
+
+    estimation_matrix = moments.estimation_matrix(estimator_matrix)
+    if moments.count < 2 or estimation_matrix[~np.isnan(estimation_matrix)].size == 0:
+        shutil.rmtree(jobs_dir, ignore_errors=True)
+        return False, False
+    eigenvals, all_eigenvectors = eigen_decomposition(estimation_matrix)
+    if n_pc in COMPONENT_RULES:
+        n_pc = select_components(eigenvals, n_pc, variance_threshold)
+    n_pc = min(n_pc, n_bands)
+    all_component_std = np.sqrt(np.maximum(np.diag(all_eigenvectors.T @ moments.covariance() @ all_eigenvectors), 0))
+
+    pca_stats = {}
+    pca_stats["estimator"] = estimator_matrix
+    pca_stats["eigenvals"] = eigenvals
+    pca_stats["eigenvals_%"] = eigenvals * 100 / n_bands
+    pca_stats["eigenvectors"] = all_eigenvectors[:, :n_pc]
+    pca_stats["all_eigenvectors"] = all_eigenvectors
+    pca_stats["band_labels"] = band_labels
+    pca_stats["band_mean"] = moments.mean
+    pca_stats["band_std"] = moments.std()
+    pca_stats["component_std"] = all_component_std[:n_pc]
+    pca_stats["all_component_std"] = all_component_std
+    pca_stats["derived_input"] = derived_input
+    pca_stats["expressions"] = expressions or None
+
+    ########
+    # projection jobs with the transform of the merge step, and the assembly of the tiles
+
+    transform_file = jobs_dir / "transform.json"
+    save_transform(pca_stats, transform_file)
+    projection_jobs = [
+        dict(
+            inputs,
+            task="projection",
+            window=list(tile),
+            transform=str(transform_file),
+            output=str(jobs_dir / f"components_{idx + 1}.npy"),
+        )
+        for idx, tile in enumerate(tiles)
+    ]
+    write_jobs(projection_jobs, jobs_dir, "projection")
+    outputs = run_jobs(projection_jobs, n_threads, executor)
+
+    reader = StackReader(A, B, band_list)
+    writer = ComponentWriter(
+        out_dir, n_pc, reader, nodata, precision=precision, component_std=pca_stats["component_std"]
+    )
+    try:
+        for tile, output in zip(tiles, outputs, strict=True):
+            # tiles with only nodata, left sparse in the outputs
+            if output is None:
+                continue
+            components = np.load(output, mmap_mode="r")
+            for window in tile_windows(tile, block_size):
+                rows = slice(window[1] - tile[1], window[1] - tile[1] + window[3])
+                writer.write(window, np.array(components[:, rows]))
+            del components
+    finally:
+        pca_files = writer.close()
+        reader.close()
+    shutil.rmtree(jobs_dir, ignore_errors=True)
+
+    # compute the pyramids for each pc image
+    build_overviews(pca_files)
+
+    pca_stats["pca_files"] = pca_files
+
+    return pca_files, pca_stats
+
+
+if __name__ == "__main__":
+    for job_path in sys.argv[1:]:
+        run_job(job_path)
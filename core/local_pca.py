@@ -0,0 +1,317 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from pca4cd.core.block_io import BlockBuffers, ComponentWriter, StackReader, build_overviews, nodata_mask
+from pca4cd.core.gdal_profile import gdal_config_options
+from pca4cd.core.moments import COMPONENT_RULES, Moments, eigen_decomposition, select_components
+from pca4cd.core.pca_numpy_gdal import profile_options
+from pca4cd.core.pipeline import run_pipeline
+from pca4cd.core.staging import stage_inputs
+from pca4cd.utils.system_utils import wait_process
+
+
+def tile_layout(x_size, y_size, tile_size, overlap):
+    """Split the raster in tiles of tile_size pixels extended by the overlap
+    on each side (inside the raster)
+
+    :return: list of (xoff, yoff, xsize, ysize) extended tile windows
+    """
+    tiles = []
+    for yoff in range(0, y_size, tile_size):
+        for xoff in range(0, x_size, tile_size):
+            x_start, y_start = max(0, xoff - overlap), max(0, yoff - overlap)
+            x_end, y_end = min(x_size, xoff + tile_size + overlap), min(y_size, yoff + tile_size + overlap)
+            tiles.append((x_start, y_start, x_end - x_start, y_end - y_start))
+    return tiles
+
+
+def feather(start, end, size, overlap, positions):
+    """Blending weight of the tile [start, end) along one axis of the raster,
+    1 in the core of the tile and a linear ramp to 0 across the overlap, the
+    sides at the border of the raster are not ramped
+    """
+    distance = np.full(positions.shape, np.inf)
+    if start > 0:
+        distance = np.minimum(distance, positions - start)
+    if end < size:
+        distance = np.minimum(distance, end - 1 - positions)
+    return np.clip((distance + 1) / (overlap + 1), 0, 1)
+
+
+def align_components(eigenvectors, reference):
+    """Order and signs of the eigenvectors of a tile matching the reference
+    (global) ones, so the same component has the same meaning in all the
+    tiles and the blending does not cancel them
+
+    :return: eigenvectors matched to each reference component, in its order
+    """
+    similarity = eigenvectors.T @ reference
+    aligned = np.empty_like(reference)
+    free = list(range(eigenvectors.shape[1]))
+    for component in range(reference.shape[1]):
+        best = max(free, key=lambda idx: abs(similarity[idx, component]))
+        free.remove(best)
+        sign = -1 if similarity[best, component] < 0 else 1
+        aligned[:, component] = sign * eigenvectors[:, best]
+    return aligned
+
+
+@wait_process
+def local_pca(
+    A,
+    B,
+    n_pc,
+    estimator_matrix,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata=None,
+    tile_size=1024,
+    overlap=None,
+    queue_depth=2,
+    gdal_profile="Balanced",
+    memory_budget=4096,
+    staging=True,
+    band_list=None,
+    precision="Float32",
+    variance_threshold=0.95,
+):
+    """Local PCA: the principal components of each tile of the image with
+    its own moments and eigenvectors, so the regional differences of large
+    mosaics do not dominate the components
+
+    The moments of all the tiles are accumulated in the same streaming pass
+    (the blocks are computed in parallel) and the tiles are decomposed in
+    parallel. The components of each tile are aligned in order and sign with
+    the global PCA and blended with feathered weights across the overlaps,
+    the outputs are the same pc_N.tif files of pca().
+
+    :param A: first input raster data (fists period)
+    :param B: second input raster data (second period) or None
+    :param n_pc: number of principal components to output, or a rule of
+        COMPONENT_RULES to choose it from the eigenvalues of the global PCA, see pca()
+    :param estimator_matrix: pca with correlation of covariance
+    :param out_dir: directory to save the outputs
+    :param n_threads: number of compute workers
+    :param block_size: blocks of about block_size**2 pixels
+    :param nodata: nodata value of the inputs or None
+    :param tile_size: size in pixels of the tiles
+    :param overlap: pixels that each tile extends into its neighbours, used in
+        its moments and blended, tile_size // 8 by default
+    :param queue_depth: number of blocks waiting between the pipeline stages
+    :param gdal_profile: GDAL performance profile set during the run (see GDAL_PROFILES)
+    :param memory_budget: memory budget of the run in MB, used to size the GDAL profile
+    :param staging: decode the compressed inputs only once, see pca()
+    :param band_list: band numbers in the stack of A and B to use, see pca()
+    :param precision: storage of the components, see pca()
+    :param variance_threshold: fraction of the variance with the "Cumulative variance" rule
+    :return: pca files list and statistics (of the global PCA, with the number of tiles)
+    """
+    gdal_options = profile_options(A, B, n_threads, block_size, queue_depth, gdal_profile, memory_budget, band_list)
+    with gdal_config_options(gdal_options):
+        return stream_local_pca(
+            A,
+            B,
+            n_pc,
+            estimator_matrix,
+            out_dir,
+            n_threads,
+            block_size,
+            nodata,
+            tile_size=tile_size,
+            overlap=tile_size // 8 if overlap is None else overlap,
+            queue_depth=queue_depth,
+            staging=staging,
+            band_list=band_list,
+            precision=precision,
+            variance_threshold=variance_threshold,
+        )
+
+
+def stream_local_pca(
+    A,
+    B,
+    n_pc,
+    estimator_matrix,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata=None,
+    tile_size=1024,
+    overlap=128,
+    queue_depth=2,
+    staging=True,
+    band_list=None,
+    precision="Float32",
+    variance_threshold=0.95,
+):
+    """The two passes of the local PCA, see local_pca()"""
+    reader = StackReader(A, B, band_list)
+    n_bands = reader.n_bands
+    # with a rule the number of components is chosen after the moment pass
+    max_pc = n_bands if n_pc in COMPONENT_RULES else min(n_pc, n_bands)
+    x_size, y_size = reader.x_size, reader.y_size
+    tiles = tile_layout(x_size, y_size, tile_size, overlap)
+    if staging:
+        staged = stage_inputs(reader, A, B, Path(out_dir) / "staging", extra_bytes=max_pc * x_size * y_size * 4)
+        if staged is not None:
+            reader.stage(staged)
+    buffers = BlockBuffers(reader.block_shape(block_size))
+
+    def tiles_in(window):
+        """Tiles crossing the rows of the window and the rows of the block of each one"""
+        _, yoff, _, ysize = window
+        for idx, (tile_x, tile_y, tile_xsize, tile_ysize) in enumerate(tiles):
+            row_start, row_end = max(yoff, tile_y), min(yoff + ysize, tile_y + tile_ysize)
+            if row_start < row_end:
+                yield idx, slice(row_start - yoff, row_end - yoff), slice(tile_x, tile_x + tile_xsize)
+
+    def valid_pixels(data, mask):
+        flat_dims = data.reshape((n_bands, -1))
+        return flat_dims if mask is None else flat_dims[:, ~mask.ravel()]
+
+    ########
+    # moment pass: the global moments and the moments of each tile
+
+    def block_moments(block):
+        window, data = block
+        if data is None:
+            return Moments(n_bands), {}
+        try:
+            mask = nodata_mask(data, nodata)
+            if mask is not None and mask.all():
+                return Moments(n_bands), {}
+            tile_moments = {}
+            for idx, rows, cols in tiles_in(window):
+                tile_mask = None if mask is None else mask[rows, cols]
+                tile_moments[idx] = Moments.from_block(valid_pixels(data[:, rows, cols], tile_mask))
+            return Moments.from_block(valid_pixels(data, mask)), tile_moments
+        finally:
+            buffers.release(data)
+
+    moments = Moments(n_bands)
+    tiles_moments = [Moments(n_bands) for _ in tiles]
+
+    def merge(block_global, block_tiles):
+        moments.merge(block_global)
+        for idx, tile_moments in block_tiles.items():
+            tiles_moments[idx].merge(tile_moments)
+
+    run_pipeline(
+        reader.blocks(block_size, buffers, nodata),
+        block_moments,
+        lambda _, block_moments: merge(*block_moments),
+        n_threads,
+        queue_depth,
+    )
+
+    ########
+    # eigenvectors of the global PCA and of each tile, aligned with the global ones
+
+    estimation_matrix = moments.estimation_matrix(estimator_matrix)
+    if moments.count < 2 or estimation_matrix[~np.isnan(estimation_matrix)].size == 0:
+        reader.close()
+        return False, False
+    eigenvals, all_eigenvectors = eigen_decomposition(estimation_matrix)
+    n_pc = select_components(eigenvals, n_pc, variance_threshold) if n_pc in COMPONENT_RULES else max_pc
+    eigenvectors = all_eigenvectors[:, :n_pc]
+
+    def tile_decomposition(tile_moments):
+        """Mean and aligned eigenvectors of the tile, the global ones if the
+        tile has not enough valid pixels
+        """
+        estimation_matrix = tile_moments.estimation_matrix(estimator_matrix)
+        if tile_moments.count <= n_bands or np.isnan(estimation_matrix).any():
+            return moments.mean, eigenvectors
+        _, tile_eigenvectors = eigen_decomposition(estimation_matrix)
+        return tile_moments.mean, align_components(tile_eigenvectors, eigenvectors)
+
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+        tiles_decomposition = list(executor.map(tile_decomposition, tiles_moments))
+
+    ########
+    # projection pass: components of each tile blended with the feather weights
+
+    def project(block):
+        window, data = block
+        if data is None:
+            return window, None
+        try:
+            mask = nodata_mask(data, nodata)
+            if mask is not None and mask.all():
+                return window, None
+            _, yoff, _, ysize = window
+            blended = np.zeros((n_pc, ysize, x_size))
+            weights = np.zeros((ysize, x_size))
+            for idx, rows, cols in tiles_in(window):
+                tile_x, tile_y, tile_xsize, tile_ysize = tiles[idx]
+                tile_mean, tile_eigenvectors = tiles_decomposition[idx]
+                weight = np.outer(
+                    feather(tile_y, tile_y + tile_ysize, y_size, overlap, np.arange(yoff, yoff + ysize)[rows]),
+                    feather(tile_x, tile_x + tile_xsize, x_size, overlap, np.arange(tile_x, tile_x + tile_xsize)),
+                )
+                tile_data = data[:, rows, cols].reshape((n_bands, -1))
+                pc = tile_eigenvectors.T @ (tile_data - tile_mean[:, None])
+                blended[:, rows, cols] += pc.reshape((n_pc, *weight.shape)) * weight
+                weights[rows, cols] += weight
+            pc = (blended / weights).astype(np.float32)
+            if mask is not None:
+                pc[:, mask] = nodata
+            return window, pc
+        finally:
+            buffers.release(data)
+
+    # the scale of the Int16 outputs from the global components, the local ones are similar
+    component_std = np.sqrt(np.maximum(np.diag(eigenvectors.T @ moments.covariance() @ eigenvectors), 0))
+    writer = ComponentWriter(out_dir, n_pc, reader, nodata, precision=precision, component_std=component_std)
+    try:
+        run_pipeline(
+            reader.blocks(block_size, buffers, nodata),
+            project,
+            lambda _, block_pc: writer.write(*block_pc),
+            n_threads,
+            queue_depth,
+        )
+    finally:
+        pca_files = writer.close()
+        reader.close()
+
+    # compute the pyramids for each pc image
+    build_overviews(pca_files)
+
+    ########
+    # pca statistics of the global PCA
+    pca_stats = {}
+    pca_stats["estimator"] = estimator_matrix
+    pca_stats["eigenvals"] = eigenvals
+    pca_stats["eigenvals_%"] = eigenvals * 100 / n_bands
+    pca_stats["eigenvectors"] = eigenvectors
+    pca_stats["all_eigenvectors"] = all_eigenvectors
+    pca_stats["band_labels"] = reader.band_labels
+    pca_stats["component_std"] = component_std
+    pca_stats["pca_files"] = pca_files
+    pca_stats["tiles"] = len(tiles)
+
+    return pca_files, pca_stats
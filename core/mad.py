@@ -0,0 +1,279 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+from pca4cd.core.block_io import BlockBuffers, ComponentWriter, StackReader, build_overviews, nodata_mask
+from pca4cd.core.gdal_profile import gdal_config_options
+from pca4cd.core.moments import Moments
+from pca4cd.core.pca_numpy_gdal import profile_options
+from pca4cd.core.pipeline import run_pipeline
+from pca4cd.core.staging import stage_inputs
+from pca4cd.utils.system_utils import wait_process
+
+# maximum number of reweighting passes of the iMAD
+IMAD_MAX_ITERATIONS = 30
+
+
+def erfc(x):
+    """Complementary error function for x >= 0 (Abramowitz and Stegun 7.1.26,
+    absolute error < 1.5e-7), vectorized without scipy
+    """
+    t = 1 / (1 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return poly * np.exp(-x * x)
+
+
+def chi2_sf(z, dof):
+    """Survival function P(X > z) of the chi-square distribution with an
+    integer number of degrees of freedom, with the closed forms of the
+    regularized incomplete gamma function for even and odd dof
+    """
+    half = np.asarray(z, dtype=np.float64) / 2
+    if dof % 2 == 0:
+        term = np.ones_like(half)
+        total = np.ones_like(half)
+        for i in range(1, dof // 2):
+            term = term * half / i
+            total += term
+        return np.exp(-half) * total
+    root = np.sqrt(half)
+    # gamma(3/2) = sqrt(pi)/2
+    term = root / (np.sqrt(np.pi) / 2)
+    total = np.zeros_like(half)
+    for j in range(1, (dof - 1) // 2 + 1):
+        total += term
+        term = term * half / (j + 0.5)
+    return erfc(root) + np.exp(-half) * total
+
+
+def canonical_correlation(moments, n_bands_A):
+    """Canonical correlation analysis of the bands of A and B from the joint moments
+
+    :return: canonical correlations in increasing order (the first MAD has
+        the largest variance) and the transformations a (A) and b (B) with
+        the canonical variates normalized to unit variance
+    """
+    covariance = moments.covariance()
+    s_aa = covariance[:n_bands_A, :n_bands_A]
+    s_bb = covariance[n_bands_A:, n_bands_A:]
+    s_ab = covariance[:n_bands_A, n_bands_A:]
+
+    # generalized eigenproblem s_ab s_bb^-1 s_ba a = rho^2 s_aa a as a symmetric one
+    l_inv = np.linalg.inv(np.linalg.cholesky(s_aa))
+    matrix = l_inv @ s_ab @ np.linalg.solve(s_bb, s_ab.T) @ l_inv.T
+    rho2, eigenvectors = np.linalg.eigh((matrix + matrix.T) / 2)
+    rho = np.sqrt(np.clip(rho2, 0, 1))
+    a = l_inv.T @ eigenvectors
+    # b with the same sign, positively correlated with a
+    b = np.linalg.solve(s_bb, s_ab.T @ a) / np.maximum(rho, np.finfo(float).eps)
+    return rho, a, b
+
+
+class MADTransform:
+    """MAD variates and chi-square change statistic of the pixels"""
+
+    def __init__(self, moments, n_bands_A):
+        self.mean = moments.mean
+        self.n_bands_A = n_bands_A
+        self.rho, self.a, self.b = canonical_correlation(moments, n_bands_A)
+        # variance of each MAD variate
+        self.sigma2 = np.maximum(2 * (1 - self.rho), np.finfo(float).eps)
+
+    def variates(self, X):
+        """MAD variates of the valid pixels X with shape (bands, pixels)"""
+        centered = X - self.mean[:, None]
+        return self.a.T @ centered[: self.n_bands_A] - self.b.T @ centered[self.n_bands_A :]
+
+    def chi_square(self, mads):
+        """Sum of the squared standardized MADs, chi-square with n_bands_A dof for no-change pixels"""
+        return (mads**2 / self.sigma2[:, None]).sum(axis=0)
+
+    def no_change_probability(self, X):
+        """Weights of the iMAD: probability of no-change of the pixels"""
+        return chi2_sf(self.chi_square(self.variates(X)), self.n_bands_A)
+
+
+@wait_process
+def mad(
+    A,
+    B,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata=None,
+    max_iterations=1,
+    tolerance=1e-4,
+    queue_depth=2,
+    gdal_profile="Balanced",
+    memory_budget=4096,
+    staging=True,
+    band_list=None,
+):
+    """Multivariate alteration detection (MAD) between A and B, or its
+    iteratively reweighted variant (iMAD) with max_iterations > 1
+
+    Each iteration is a streaming pass of the block pipeline that accumulates
+    the joint moments of A and B, weighted by the no-change probability of
+    each pixel from the previous iteration (the first one is unweighted).
+
+    :param A: first input raster data (fists period)
+    :param B: second input raster data (second period), same number of bands as A
+    :param out_dir: directory to save the outputs
+    :param n_threads: number of compute workers
+    :param block_size: blocks of about block_size**2 pixels
+    :param nodata: nodata value of the inputs or None
+    :param max_iterations: 1 for MAD, maximum number of reweighting passes for iMAD
+    :param tolerance: the iMAD stops when the canonical correlations change less than it
+    :param queue_depth: number of blocks waiting between the pipeline stages
+    :param gdal_profile: GDAL performance profile set during the run (see GDAL_PROFILES)
+    :param memory_budget: memory budget of the run in MB, used to size the GDAL profile
+    :param staging: decode the compressed inputs only once, see pca()
+    :param band_list: band numbers in the stack of A and B to use, see pca(),
+        the same number of bands of A and of B
+    :return: files of the MAD variates and the chi-square statistic, and statistics
+    """
+    gdal_options = profile_options(A, B, n_threads, block_size, queue_depth, gdal_profile, memory_budget, band_list)
+    with gdal_config_options(gdal_options):
+        return stream_mad(
+            A, B, out_dir, n_threads, block_size, nodata, max_iterations, tolerance, queue_depth, staging, band_list
+        )
+
+
+def stream_mad(
+    A, B, out_dir, n_threads, block_size, nodata, max_iterations, tolerance, queue_depth, staging, band_list=None
+):
+    """The passes of the MAD/iMAD, see mad()"""
+    reader = StackReader(A, B, band_list)
+    n_bands = reader.n_bands
+    n_bands_A = reader.input_bands[0]
+    if n_bands != 2 * n_bands_A:
+        reader.close()
+        raise ValueError("The MAD requires the same number of bands in A and B")
+    if staging:
+        output_bytes = (n_bands_A + 1) * reader.x_size * reader.y_size * 4
+        staged = stage_inputs(reader, A, B, Path(out_dir) / "staging", extra_bytes=output_bytes)
+        if staged is not None:
+            reader.stage(staged)
+    buffers = BlockBuffers(reader.block_shape(block_size))
+
+    def valid_pixels(data):
+        """Valid pixels of the block with shape (bands, pixels), or None if all are masked"""
+        mask = nodata_mask(data, nodata)
+        if mask is not None and mask.all():
+            return None
+        flat_dims = data.reshape((n_bands, -1))
+        return flat_dims if mask is None else flat_dims[:, ~mask.ravel()]
+
+    ########
+    # moment passes, weighted with the transform of the previous iteration
+    transform = None
+
+    def block_moments(block):
+        _, data = block
+        if data is None:
+            return Moments(n_bands)
+        try:
+            X = valid_pixels(data)
+            if X is None:
+                return Moments(n_bands)
+            weights = None if transform is None else transform.no_change_probability(X)
+            return Moments.from_block(X, weights)
+        finally:
+            buffers.release(data)
+
+    iterations = 0
+    for iteration in range(max(1, max_iterations)):
+        iterations = iteration + 1
+        moments = Moments(n_bands)
+        run_pipeline(
+            reader.blocks(block_size, buffers, nodata),
+            block_moments,
+            lambda _, block_moments, moments=moments: moments.merge(block_moments),
+            n_threads,
+            queue_depth,
+        )
+        if moments.count < 2 or np.isnan(moments.cross).any():
+            reader.close()
+            return False, False
+        previous = transform
+        try:
+            transform = MADTransform(moments, n_bands_A)
+        except np.linalg.LinAlgError:
+            reader.close()
+            return False, False
+        if previous is not None and np.max(np.abs(transform.rho - previous.rho)) < tolerance:
+            break
+
+    ########
+    # projection pass: save the MAD variates and the chi-square statistic
+
+    def project(block):
+        window, data = block
+        if data is None:
+            return window, None
+        try:
+            mask = nodata_mask(data, nodata)
+            if mask is not None and mask.all():
+                return window, None
+            X = data.reshape((n_bands, -1)).astype(np.float64)
+            mads = transform.variates(X)
+            components = np.vstack([mads, transform.chi_square(mads)]).astype(np.float32)
+            if mask is not None:
+                components[:, mask.ravel()] = nodata
+            return window, components.reshape((n_bands_A + 1, *data.shape[1:]))
+        finally:
+            buffers.release(data)
+
+    mad_writer = ComponentWriter(out_dir, n_bands_A, reader, nodata, prefix="mad")
+    chi2_writer = ComponentWriter(out_dir, 1, reader, nodata, prefix="chi2")
+
+    def write(window, components):
+        mad_writer.write(window, None if components is None else components[:n_bands_A])
+        chi2_writer.write(window, None if components is None else components[n_bands_A:])
+
+    try:
+        run_pipeline(
+            reader.blocks(block_size, buffers, nodata),
+            project,
+            lambda _, block_components: write(*block_components),
+            n_threads,
+            queue_depth,
+        )
+    finally:
+        mad_files = mad_writer.close() + chi2_writer.close()
+        reader.close()
+
+    build_overviews(mad_files)
+
+    ########
+    # mad statistics
+    mad_stats = {}
+    mad_stats["estimator"] = "iMAD" if max_iterations > 1 else "MAD"
+    mad_stats["eigenvals"] = None
+    mad_stats["canonical_correlations"] = transform.rho
+    mad_stats["iterations"] = iterations
+    mad_stats["band_labels"] = reader.band_labels
+    mad_stats["component_labels"] = [f"MAD {i + 1}" for i in range(n_bands_A)] + ["Chi-square"]
+    mad_stats["pca_files"] = mad_files
+
+    return mad_files, mad_stats
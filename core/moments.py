@@ -0,0 +1,176 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+# estimator matrices of the PCA, both from the same moments
+ESTIMATORS = ("Correlation", "Covariance")
+# rules to choose the number of components from the eigenvalues (see select_components)
+COMPONENT_RULES = ("Cumulative variance", "Broken stick", "Kaiser")
+
+
+class Moments:
+    """Mergeable first and second order moments of the bands
+
+    Each block keeps its own mean and centered cross products, the blocks
+    are combined with the pairwise update of Chan et al., that is stable
+    even for large values and a very large number of pixels.
+    """
+
+    def __init__(self, n_bands):
+        self.count = 0
+        self.mean = np.zeros(n_bands)
+        # sum of the cross products of the deviations to the mean
+        self.cross = np.zeros((n_bands, n_bands))
+
+    @classmethod
+    def from_block(cls, X, weights=None):
+        """Moments of a block of valid pixels with shape (bands, pixels)
+
+        :param weights: weight of each pixel or None, with weights the count
+            is the sum of the weights
+        """
+        moments = cls(X.shape[0])
+        if X.shape[1] == 0:
+            return moments
+        X = X.astype(np.float64)
+        if weights is None:
+            moments.count = X.shape[1]
+            moments.mean = X.mean(axis=1)
+            X -= moments.mean[:, None]
+            moments.cross = X @ X.T
+            return moments
+        weights = weights.astype(np.float64)
+        moments.count = weights.sum()
+        if moments.count == 0:
+            moments.count = 0
+            return moments
+        moments.mean = X @ weights / moments.count
+        X -= moments.mean[:, None]
+        moments.cross = (X * weights) @ X.T
+        return moments
+
+    def merge(self, other):
+        """Add the moments of other to this one (in place)"""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.cross = other.count, other.mean.copy(), other.cross.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.cross = self.cross + other.cross + np.outer(delta, delta) * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def subset(self, bands):
+        """Moments of a subset of the bands, e.g. the bands of one period"""
+        moments = Moments(len(bands))
+        moments.count = self.count
+        moments.mean = self.mean[bands]
+        moments.cross = self.cross[np.ix_(bands, bands)]
+        return moments
+
+    def save(self, file_path):
+        """Save the moments in a .npz file, to merge them in another process,
+        the file appears complete or not at all
+        """
+        file_path = Path(file_path)
+        tmp_file = file_path.with_name(file_path.name + ".tmp")
+        with open(tmp_file, "wb") as moments_file:
+            np.savez(moments_file, count=self.count, mean=self.mean, cross=self.cross)
+        os.replace(tmp_file, file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        """Moments saved with save()"""
+        with np.load(file_path) as saved:
+            moments = cls(len(saved["mean"]))
+            moments.count = saved["count"].item()
+            moments.mean = saved["mean"]
+            moments.cross = saved["cross"]
+        return moments
+
+    def covariance(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.cross / (self.count - 1)
+
+    def std(self):
+        return np.sqrt(np.diag(self.covariance()))
+
+    def correlation(self):
+        std = self.std()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.covariance() / np.outer(std, std)
+
+    def estimation_matrix(self, estimator_matrix):
+        """Matrix correlation or covariance of the bands"""
+        if estimator_matrix == "Correlation":
+            return self.correlation()
+        if estimator_matrix == "Covariance":
+            return self.covariance()
+        raise ValueError(f"Unknown estimator matrix: {estimator_matrix}")
+
+
+def eigen_decomposition(estimation_matrix):
+    """Eigenvalues and eigenvectors sorted in decreasing order of the eigenvalues"""
+    # use 'eigh' rather than 'eig' since estimation_matrix
+    # is symmetric, the performance gain is substantial
+    eigenvals, eigenvectors = np.linalg.eigh(estimation_matrix)
+
+    # sort eigenvalue in decreasing order
+    idx_eigenvals = np.argsort(eigenvals)[::-1]
+    # sort eigenvectors according to same index
+    return eigenvals[idx_eigenvals], eigenvectors[:, idx_eigenvals]
+
+
+def select_components(eigenvals, rule, variance_threshold=0.95):
+    """Number of components that carry the signal according to the rule
+
+    :param eigenvals: eigenvalues in decreasing order
+    :param rule: "Cumulative variance": the first components that explain the
+        variance_threshold of the total variance, "Broken stick": the first
+        components with more variance than expected by the broken stick model,
+        "Kaiser": the components with more variance than the average (the
+        eigenvalues greater than 1 with the correlation matrix)
+    :param variance_threshold: fraction of the variance for "Cumulative variance"
+    :return: number of components, at least one
+    """
+    eigenvals = np.clip(np.asarray(eigenvals, dtype=np.float64), 0, None)
+    n_bands = len(eigenvals)
+    total = eigenvals.sum()
+    if n_bands == 0 or total == 0:
+        return 1
+    if rule == "Cumulative variance":
+        n_components = int(np.searchsorted(np.cumsum(eigenvals) / total, variance_threshold - 1e-12) + 1)
+    elif rule == "Broken stick":
+        # expected fraction of the variance of the k-th largest piece of a stick broken at random
+        broken_stick = np.cumsum(1 / np.arange(n_bands, 0, -1))[::-1] / n_bands
+        above = eigenvals / total > broken_stick
+        n_components = n_bands if above.all() else int(np.argmin(above))
+    elif rule == "Kaiser":
+        n_components = int(np.count_nonzero(eigenvals > eigenvals.mean()))
+    else:
+        raise ValueError(f"Unknown rule to select the components: {rule}")
+    return min(max(n_components, 1), n_bands)
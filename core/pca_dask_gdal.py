@@ -24,91 +24,157 @@ from pathlib import Path
 import numpy as np
 from osgeo import gdal
 
+from pca4cd.core.block_io import ComponentWriter, StackReader, block_windows, build_overviews, nodata_mask
+from pca4cd.core.dask_cluster import start_cluster
+from pca4cd.core.moments import COMPONENT_RULES, select_components
 from pca4cd.utils.system_utils import wait_process
 
 
+def read_valid_pixels(A, B, band_list, window, nodata):
+    """Valid pixels of the window of the stack with shape (bands, pixels), read
+    where the chunk is computed (the workers of the cluster) with one plain
+    GDAL read of each input, the StackReader setup (the layout of all the
+    bands) would be repeated for every window
+    """
+    xoff, yoff, xsize, ysize = window
+    blocks = []
+    offset = 0
+    for file_path in (A, B):
+        if not file_path:
+            continue
+        src_ds = gdal.Open(str(file_path), gdal.GA_ReadOnly)
+        input_band_list = [
+            band for band in range(1, src_ds.RasterCount + 1) if band_list is None or offset + band in band_list
+        ]
+        offset += src_ds.RasterCount
+        if input_band_list:
+            data = np.empty((len(input_band_list), ysize, xsize), dtype=np.float32)
+            src_ds.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=data, band_list=input_band_list)
+            blocks.append(data)
+        src_ds = None
+    flat_dims = np.concatenate(blocks).reshape((sum(len(data) for data in blocks), -1))
+    if nodata is None:
+        return flat_dims
+    return flat_dims[:, ~nodata_mask(flat_dims[:, None], nodata).ravel()]
+
+
 @wait_process
-def pca(A, B, n_pc, estimator_matrix, out_dir, n_threads, block_size, nodata=None):
+def pca(
+    A,
+    B,
+    n_pc,
+    estimator_matrix,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata=None,
+    band_list=None,
+    variance_threshold=0.95,
+    cluster=False,
+    memory_budget=4096,
+):
     """Calculate the principal components for the vertical stack A or with
     combinations of the stack B
 
     :param A: first input raster data (fists period)
     :param B: second input raster data (second period) or None
-    :param n_pc: number of principal components to output
+    :param n_pc: number of principal components to output, or a rule of
+        COMPONENT_RULES to choose it from the eigenvalues (see select_components)
     :param estimator_matrix: pca with correlation of covariance
     :param out_dir: directory to save the outputs
+    :param band_list: band numbers (starting at 1) in the stack of A and B to
+        use, all by default
+    :param variance_threshold: fraction of the variance with the "Cumulative variance" rule
+    :param cluster: compute the moments in a dask.distributed LocalCluster of
+        n_threads worker processes (see core.dask_cluster) instead of threads,
+        the workers read their blocks and keep the valid pixels in memory,
+        spilled to disk in out_dir above the memory limit of each worker
+    :param memory_budget: memory budget of the cluster in MB, split between the workers
     :return: pca files list and statistics
     """
     import dask
     from dask import array as da
 
-    # init dask as threads (shared memory is required)
-    dask.config.set(pool=ThreadPool(n_threads))
-
-    raw_image = []
-    nodata_mask = None
-    band_labels = []
-    src_ds_A = gdal.Open(str(A), gdal.GA_ReadOnly)
-    src_ds_B = None
-    for band in range(src_ds_A.RasterCount):
-        ds = src_ds_A.GetRasterBand(band + 1).ReadAsArray().flatten().astype(np.float32)
-        if nodata is not None and np.isnan(nodata):
-            nodata_mask = np.isnan(ds) if nodata_mask is None else np.logical_or(nodata_mask, np.isnan(ds))
-        elif nodata is not None:
-            nodata_mask = ds == nodata if nodata_mask is None else np.logical_or(nodata_mask, ds == nodata)
-        raw_image.append(ds)
-        band_labels.append(f"A·B{band + 1}" if B else f"B{band + 1}")
-    if B:
-        src_ds_B = gdal.Open(str(B), gdal.GA_ReadOnly)
-        for band in range(src_ds_B.RasterCount):
-            ds = src_ds_B.GetRasterBand(band + 1).ReadAsArray().flatten().astype(np.float32)
-            if nodata is not None and np.isnan(nodata):
-                nodata_mask = np.logical_or(nodata_mask, np.isnan(ds))
-            elif nodata is not None:
-                nodata_mask = np.logical_or(nodata_mask, ds == nodata)
-            raw_image.append(ds)
-            band_labels.append(f"B·B{band + 1}")
-
-    # pair-masking data, let only the valid data across all dimensions/bands
-    if nodata is not None:
-        raw_image = [b[~nodata_mask] for b in raw_image]
-    # flat each dimension (bands)
-    flat_dims = da.vstack(raw_image).rechunk((1, block_size**2))
-    # bands
-    n_bands = flat_dims.shape[0]
-
-    ########
-    # compute the mean of each band, in order to center the matrix.
-    band_mean = []
-    for i in range(n_bands):
-        band_mean.append(dask.delayed(np.mean)(flat_dims[i]))
-    band_mean = dask.compute(*band_mean)
-
-    ########
-    # compute the matrix correlation/covariance
-    estimation_matrix = np.empty((n_bands, n_bands))
-    if estimator_matrix == "Correlation":
+    # the reader picks the read strategy of each input from its layout
+    reader = StackReader(A, B, band_list)
+    band_labels = reader.band_labels
+    rows, cols = reader.y_size, reader.x_size
+    n_bands = reader.n_bands
+
+    pool = None
+    if cluster:
+        client = start_cluster(n_threads, memory_budget, Path(out_dir) / "dask-spill")
+        scheduler = dask.config.set(scheduler=client)
+    else:
+        # dask as threads (shared memory is required), only during this run
+        pool = ThreadPool(n_threads)
+        scheduler = dask.config.set(pool=pool)
+
+    with scheduler:
+        stack = None
+        if cluster:
+            # each chunk is read by a worker, the valid pixels stay in the
+            # memory of the workers for all the passes
+            chunks = [
+                da.from_delayed(
+                    dask.delayed(read_valid_pixels)(A, B, band_list, window, nodata),
+                    shape=(n_bands, np.nan),
+                    dtype=np.float32,
+                )
+                for window in block_windows(cols, rows, block_size)
+            ]
+            flat_dims = client.persist(da.concatenate(chunks, axis=1))
+            flat_dims.compute_chunk_sizes()
+        else:
+            # preallocated stack filled in place by GDAL, one flat row per band,
+            # the data type is converted directly into it without temporary arrays
+            stack = np.empty((n_bands, rows * cols), dtype=np.float32)
+            reader.read((0, 0, cols, rows), out=stack.reshape((n_bands, rows, cols)))
+            # pair-masking data, let only the valid data across all dimensions/bands,
+            # compacted in place at the beginning of each row of the stack
+            n_valid = stack.shape[1]
+            if nodata is not None:
+                valid = ~nodata_mask(stack[:, None], nodata).ravel()
+                n_valid = int(np.count_nonzero(valid))
+                for idx in range(n_bands):
+                    stack[idx, :n_valid] = stack[idx, valid]
+                del valid
+            # flat each dimension (bands), the dask chunks are views of the stack
+            flat_dims = da.from_array(stack[:, :n_valid], chunks=(1, block_size**2))
+
+        ########
+        # compute the mean of each band, in order to center the matrix.
+        band_mean = []
         for i in range(n_bands):
-            deviation_scores_band_i = flat_dims[i] - band_mean[i]
-            for j in range(i, n_bands):
-                deviation_scores_band_j = flat_dims[j] - band_mean[j]
-                estimation_matrix[j][i] = estimation_matrix[i][j] = da.corrcoef(
-                    deviation_scores_band_i, deviation_scores_band_j
-                )[0][1]
-    if estimator_matrix == "Covariance":
-        for i in range(n_bands):
-            deviation_scores_band_i = flat_dims[i] - band_mean[i]
-            for j in range(i, n_bands):
-                deviation_scores_band_j = flat_dims[j] - band_mean[j]
-                estimation_matrix[j][i] = estimation_matrix[i][j] = da.cov(
-                    deviation_scores_band_i, deviation_scores_band_j
-                )[0][1]
-    # free mem
-    del raw_image, flat_dims, ds
+            band_mean.append(dask.delayed(np.mean)(flat_dims[i]))
+        band_mean = dask.compute(*band_mean)
+
+        ########
+        # compute the matrix correlation/covariance
+        estimation_matrix = np.empty((n_bands, n_bands))
+        if estimator_matrix == "Correlation":
+            for i in range(n_bands):
+                deviation_scores_band_i = flat_dims[i] - band_mean[i]
+                for j in range(i, n_bands):
+                    deviation_scores_band_j = flat_dims[j] - band_mean[j]
+                    estimation_matrix[j][i] = estimation_matrix[i][j] = da.corrcoef(
+                        deviation_scores_band_i, deviation_scores_band_j
+                    )[0][1]
+        if estimator_matrix == "Covariance":
+            for i in range(n_bands):
+                deviation_scores_band_i = flat_dims[i] - band_mean[i]
+                for j in range(i, n_bands):
+                    deviation_scores_band_j = flat_dims[j] - band_mean[j]
+                    estimation_matrix[j][i] = estimation_matrix[i][j] = da.cov(
+                        deviation_scores_band_i, deviation_scores_band_j
+                    )[0][1]
+        # free mem, also the memory of the workers
+        del flat_dims, stack
+    if pool is not None:
+        pool.close()
 
     if estimation_matrix[~np.isnan(estimation_matrix)].size == 0:
-        src_ds_A = None
-        src_ds_B = None
+        reader.close()
         return False, False
 
     ########
@@ -124,56 +190,39 @@ def pca(A, B, n_pc, estimator_matrix, out_dir, n_threads, block_size, nodata=Non
     eigenvals = eigenvals[idx_eigenvals]
     # select the first n eigenvectors (n is desired dimension
     # of rescaled data array, or dims_rescaled_data)
+    if n_pc in COMPONENT_RULES:
+        n_pc = select_components(eigenvals, n_pc, variance_threshold)
+    n_pc = min(n_pc, n_bands)
+    all_eigenvectors = eigenvectors
     eigenvectors = eigenvectors[:, :n_pc]
 
     ########
     # save the principal components separated in tif images
 
-    def get_raw_band_from_stack(band):
-        if band < src_ds_A.RasterCount:
-            return src_ds_A.GetRasterBand(band + 1).ReadAsArray().flatten().astype(np.float32)
-        if band >= src_ds_A.RasterCount:
-            return src_ds_B.GetRasterBand(band - src_ds_A.RasterCount + 1).ReadAsArray().flatten().astype(np.float32)
-
-    pca_files = []
-    for i in range(n_pc):
-        pc = 0
-        for j in range(n_bands):
-            pc = pc + eigenvectors[j, i] * (get_raw_band_from_stack(j) - band_mean[j])
-
-        if nodata is not None:
-            pc[nodata_mask] = nodata
-        pc = pc.reshape((src_ds_A.RasterYSize, src_ds_A.RasterXSize))
-        # save component as file
-        tmp_pca_file = Path(out_dir) / f"pc_{i + 1}.tif"
-        driver = gdal.GetDriverByName("GTiff")
-        out_pc = driver.Create(str(tmp_pca_file), src_ds_A.RasterXSize, src_ds_A.RasterYSize, 1, gdal.GDT_Float32)
-        pcband = out_pc.GetRasterBand(1)
-        if nodata is not None:
-            pcband.SetNoDataValue(nodata)
-        pcband.WriteArray(pc)
-        # set projection and geotransform
-        if src_ds_A.GetGeoTransform() is not None:
-            out_pc.SetGeoTransform(src_ds_A.GetGeoTransform())
-        if src_ds_A.GetProjection() is not None:
-            out_pc.SetProjection(src_ds_A.GetProjection())
-        out_pc.FlushCache()
-        del pc, pcband, out_pc
-
-        pca_files.append(tmp_pca_file)
+    # all the components are projected block by block, reading each block
+    # of the inputs once in a buffer reused for all the blocks
+    buffer = np.empty(reader.block_shape(block_size), dtype=np.float32)
+    writer = ComponentWriter(out_dir, n_pc, reader, nodata)
+    for window in block_windows(cols, rows, block_size):
+        _, _, _, ysize = window
+        data = reader.read(window, out=buffer[:, :ysize])
+        mask = nodata_mask(data, nodata)
+        # blocks with only nodata are left empty (sparse) in the outputs
+        if mask is not None and mask.all():
+            continue
+        pc = eigenvectors.T @ (data.reshape((n_bands, -1)) - np.array(band_mean)[:, None])
+        pc = pc.reshape((n_pc, ysize, cols))
+        if mask is not None:
+            pc[:, mask] = nodata
+        writer.write(window, pc)
+    pca_files = writer.close()
 
     # free mem
-    src_ds_A = None
-    src_ds_B = None
-    del nodata_mask
+    reader.close()
+    del buffer
 
     # compute the pyramids for each pc image
-    gdal.SetConfigOption("BIGTIFF_OVERVIEW", "YES")
-    for pca_file in pca_files:
-        ds = gdal.Open(str(pca_file), gdal.GA_Update)
-        ds.BuildOverviews("AVERAGE", [2, 4, 8, 16, 32])
-        ds = None
-    gdal.SetConfigOption("BIGTIFF_OVERVIEW", None)
+    build_overviews(pca_files)
 
     ########
     # pca statistics
@@ -182,6 +231,7 @@ def pca(A, B, n_pc, estimator_matrix, out_dir, n_threads, block_size, nodata=Non
     pca_stats["eigenvals"] = eigenvals
     pca_stats["eigenvals_%"] = eigenvals * 100 / n_bands
     pca_stats["eigenvectors"] = eigenvectors
+    pca_stats["all_eigenvectors"] = all_eigenvectors
     pca_stats["band_labels"] = band_labels
 
     return pca_files, pca_stats
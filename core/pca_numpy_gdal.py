@@ -0,0 +1,555 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ The PCA streamed through the staged reader/compute/writer pipeline (see
+ core.pipeline). It is a module next to the Dask pca() instead of a rewrite
+ of it: dask schedules the whole graph itself and cannot hold the bounded
+ queues and the single reader thread of the pipeline, and the Dask engine
+ is still selectable for the inputs that fit in memory (see core.engines).
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+from pca4cd.core.band_math import open_stack, rename_bands, stack_variables
+from pca4cd.core.block_io import (
+    BlockBuffers,
+    ComponentWriter,
+    StackReader,
+    WeightReader,
+    block_variables,
+    block_windows,
+    build_overviews,
+)
+from pca4cd.core.checkpoint import Checkpoint, checkpoint_key
+from pca4cd.core.gdal_profile import gdal_config_options, performance_profile
+from pca4cd.core.moments import COMPONENT_RULES, ESTIMATORS, Moments, eigen_decomposition, select_components
+from pca4cd.core.pipeline import run_pipeline
+from pca4cd.core.staging import stage_inputs, staging_key
+from pca4cd.utils.system_utils import wait_process
+
+
+@wait_process
+def pca(
+    A,
+    B,
+    n_pc,
+    estimator_matrix,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata=None,
+    queue_depth=2,
+    gdal_profile="Balanced",
+    memory_budget=4096,
+    staging=True,
+    both_estimators=False,
+    period_pcas=False,
+    derived_input=None,
+    band_list=None,
+    weights=None,
+    precision="Float32",
+    variance_threshold=0.95,
+    checkpoint_dir=None,
+    expressions=None,
+    virtual=False,
+):
+    """Calculate the principal components for the vertical stack A or with
+    combinations of the stack B, streaming the image by blocks
+
+    Both the moment pass and the projection pass run as a staged pipeline:
+    a reader thread prefetches the blocks, n_threads workers compute them and
+    a writer thread consumes the results in order, so the I/O and the
+    computation overlap and the memory is capped by the queue depth.
+
+    :param A: first input raster data (fists period)
+    :param B: second input raster data (second period) or None
+    :param n_pc: number of principal components to output, or a rule of
+        COMPONENT_RULES to choose it from the eigenvalues of each decomposition
+        before the projection pass (see select_components), only the selected
+        components are projected and the eigenvectors of all of them are in
+        pca_stats["all_eigenvectors"] to project the others on demand (see
+        core.transform)
+    :param estimator_matrix: pca with correlation of covariance
+    :param out_dir: directory to save the outputs
+    :param n_threads: number of compute workers
+    :param block_size: blocks of about block_size**2 pixels
+    :param nodata: nodata value of the inputs or None
+    :param queue_depth: number of blocks waiting between the pipeline stages
+    :param gdal_profile: GDAL performance profile set during the run (see GDAL_PROFILES)
+    :param memory_budget: memory budget of the run in MB, used to size the GDAL profile
+    :param staging: decode the compressed inputs only once, in a staging store
+        in out_dir shared by both passes and by the next runs (if there is space)
+    :param both_estimators: also compute the components of the other estimator
+        matrix from the same moments, written in the same projection pass, its
+        files and statistics are in pca_stats["alternate"]
+    :param period_pcas: with B, also compute the single-date PCAs of A and of B
+        from the sub-matrices of the joint moments, written in the same
+        projection pass, their files and statistics are in pca_stats["periods"]
+    :param derived_input: with B, the PCA of the band-wise derived variables of
+        A and B ("Difference" B-A or "Ratio" B/A, see DERIVED_INPUTS) instead of
+        the stacked bands, computed per block while reading, A and B must have
+        the same number of bands (selected)
+    :param band_list: band numbers (starting at 1) in the stack of A and B to
+        use, the bands of A first and then the ones of B, the other bands are
+        never read, all by default
+    :param weights: weight raster (e.g. a cloud mask or a per-pixel confidence)
+        streamed with the inputs, the moments are the weighted mean and
+        covariance and the blocks without any weight are not computed in the
+        moment pass, the projection still runs on all the valid pixels (see
+        WeightReader for the values read as 0)
+    :param precision: storage of the components (see OUTPUT_PRECISIONS), the
+        Int16 ones are scaled with the standard deviation of each component
+    :param variance_threshold: fraction of the variance explained by the
+        components with the "Cumulative variance" rule
+    :param checkpoint_dir: durable directory to checkpoint the run, the
+        moments accumulated and the component blocks written are saved in a
+        job directory of the run (see Checkpoint) every CHECKPOINT_INTERVAL
+        seconds, running it again with the same inputs and options resumes it
+        from the last checkpoint, the outputs are moved to out_dir at the end
+    :param expressions: band-math expressions over the bands of A and B (e.g.
+        {"NDVI": "(A4 - A3) / (A4 + A3)"}, see core.band_math) evaluated per
+        block while reading and added as extra variables after the bands (or
+        the derived ones), the bands used are read even if not selected
+    :param virtual: only the moment pass, the components are virtual rasters
+        (VRT, see core.virtual) that project the input bands with the saved
+        transform of each decomposition only for the windows read, without the
+        projection pass, and they are materialized when the whole component
+        is needed (the precision does not apply to them)
+    :return: pca files list and statistics
+    """
+    gdal_options = profile_options(A, B, n_threads, block_size, queue_depth, gdal_profile, memory_budget, band_list)
+    with gdal_config_options(gdal_options):
+        return stream_pca(
+            A,
+            B,
+            n_pc,
+            estimator_matrix,
+            out_dir,
+            n_threads,
+            block_size,
+            nodata,
+            queue_depth=queue_depth,
+            staging=staging,
+            both_estimators=both_estimators,
+            period_pcas=period_pcas,
+            derived_input=derived_input,
+            band_list=band_list,
+            weights=weights,
+            precision=precision,
+            variance_threshold=variance_threshold,
+            checkpoint_dir=checkpoint_dir,
+            expressions=expressions,
+            virtual=virtual,
+        )
+
+
+def profile_options(A, B, n_threads, block_size, queue_depth, gdal_profile, memory_budget, band_list=None):
+    """GDAL options of the profile sized with the layout of the inputs, they
+    must be set before opening the inputs again because some are read on open
+    """
+    reader = StackReader(A, B, band_list)
+    gdal_options = performance_profile(
+        gdal_profile,
+        n_threads,
+        memory_budget,
+        pipeline_bytes=2 * (n_threads + 2 * queue_depth) * reader.block_bytes(block_size),
+        cache_row_bytes=reader.cache_row_bytes(),
+    )
+    reader.close()
+    return gdal_options
+
+
+def stream_pca(
+    A,
+    B,
+    n_pc,
+    estimator_matrix,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata=None,
+    queue_depth=2,
+    staging=True,
+    both_estimators=False,
+    period_pcas=False,
+    derived_input=None,
+    band_list=None,
+    weights=None,
+    precision="Float32",
+    variance_threshold=0.95,
+    checkpoint_dir=None,
+    expressions=None,
+    virtual=False,
+):
+    """The two passes of the PCA, see pca()"""
+    reader, band_math = open_stack(A, B, band_list, expressions)
+    weight_reader = WeightReader(weights, reader) if weights else None
+    try:
+        n_bands_A, n_bands, band_labels = stack_variables(reader, band_math, derived_input)
+    except ValueError:
+        reader.close()
+        raise
+    # band indexes of each period in the variables, with the expressions of only that period
+    n_expressions = 0 if band_math is None else len(band_math.names)
+    periods = {"A": list(range(n_bands_A)), "B": list(range(n_bands_A, n_bands - n_expressions))}
+    # and those expressions for an image of the period alone (as A)
+    period_expressions = {"A": {}, "B": {}}
+    for idx in range(n_expressions):
+        if len(band_math.inputs(idx)) == 1:
+            period = band_math.inputs(idx).pop()
+            periods[period].append(n_bands - n_expressions + idx)
+            name = band_math.names[idx]
+            period_expressions[period][name] = rename_bands(band_math.expressions[name], period, "A")
+    estimators = [estimator_matrix]
+    if both_estimators:
+        estimators += [estimator for estimator in ESTIMATORS if estimator != estimator_matrix]
+    if period_pcas and B and not derived_input:
+        periods = {period: np.array(bands) for period, bands in periods.items()}
+    else:
+        periods = {}
+    if staging:
+        # with a rule the number of components is unknown yet, at most all of them
+        max_pc = n_bands if n_pc in COMPONENT_RULES else n_pc
+        output_bytes = (len(estimators) + len(periods)) * max_pc * reader.x_size * reader.y_size * 4
+        staged = stage_inputs(reader, A, B, Path(out_dir) / "staging", extra_bytes=output_bytes)
+        if staged is not None:
+            reader.stage(staged)
+    # the blocks are read in place in preallocated buffers, released after the compute
+    buffers = BlockBuffers(reader.block_shape(block_size))
+    windows = block_windows(reader.x_size, reader.y_size, block_size)
+    checkpoint = None
+    if checkpoint_dir:
+        run_key = checkpoint_key(
+            A,
+            B,
+            reader.band_labels,
+            n_pc=n_pc,
+            estimator_matrix=estimator_matrix,
+            block_size=block_size,
+            nodata=nodata,
+            both_estimators=both_estimators,
+            period_pcas=period_pcas,
+            derived_input=derived_input,
+            weights=staging_key(weights) if weights else None,
+            precision=precision,
+            variance_threshold=variance_threshold,
+            expressions=expressions,
+        )
+        checkpoint = Checkpoint(Path(checkpoint_dir) / run_key)
+
+    ########
+    # moment pass: mean and cross products of the bands
+
+    # weights of the windows, read in the reader thread with the blocks
+    block_weights = {}
+
+    def excluded(window):
+        if checkpoint is not None and checkpoint.done("moments", window):
+            return True
+        if weight_reader is None:
+            return False
+        block_weights[window] = weight_reader.read(window)
+        return not block_weights[window].any()
+
+    def block_moments(block):
+        window, data = block
+        pixel_weights = block_weights.pop(window, None)
+        # empty block, all nodata or without weights
+        if data is None:
+            return Moments(n_bands)
+        try:
+            variables, mask = block_variables(data, nodata, derived_input, n_bands_A, band_math)
+            if mask is not None and mask.all():
+                return Moments(n_bands)
+            flat_dims = variables.reshape((n_bands, -1))
+            if pixel_weights is not None:
+                pixel_weights = pixel_weights.ravel()
+            # pair-masking data, let only the valid data across all dimensions/bands
+            if mask is not None:
+                flat_dims = flat_dims[:, ~mask.ravel()]
+                if pixel_weights is not None:
+                    pixel_weights = pixel_weights[~mask.ravel()]
+            return Moments.from_block(flat_dims, pixel_weights)
+        finally:
+            buffers.release(data)
+
+    moments = Moments(n_bands)
+    if checkpoint is not None and checkpoint.moments is not None:
+        moments = checkpoint.moments
+
+    def merge(idx, block_moments):
+        moments.merge(block_moments)
+        if checkpoint is not None and checkpoint.due():
+            checkpoint.save("moments", windows[idx][1] + windows[idx][3], moments)
+
+    try:
+        if checkpoint is None or checkpoint.phase == "moments":
+            run_pipeline(
+                reader.blocks(block_size, buffers, nodata, skip=excluded if weight_reader or checkpoint else None),
+                block_moments,
+                merge,
+                n_threads,
+                queue_depth,
+            )
+    finally:
+        if weight_reader is not None:
+            weight_reader.close()
+    if checkpoint is not None and checkpoint.phase == "moments":
+        checkpoint.save("projection", 0, moments)
+
+    ########
+    # compute the matrix correlation/covariance and its eigenvectors & eigenvalues,
+    # for each estimator and each period from the same moments
+
+    def decomposition(moments, estimator, bands):
+        estimation_matrix = moments.estimation_matrix(estimator)
+        if moments.count < 2 or estimation_matrix[~np.isnan(estimation_matrix)].size == 0:
+            return None
+        eigenvals, eigenvectors = eigen_decomposition(estimation_matrix)
+        # select the first n eigenvectors (n is desired dimension
+        # of rescaled data array, or dims_rescaled_data), with the
+        # rows of the bands not used by this decomposition in zero
+        if n_pc in COMPONENT_RULES:
+            n_components = select_components(eigenvals, n_pc, variance_threshold)
+        else:
+            n_components = min(n_pc, len(bands))
+        projection = np.zeros((n_bands, n_components))
+        projection[bands] = eigenvectors[:, :n_components]
+        return {
+            "estimator": estimator,
+            "eigenvals": eigenvals,
+            "eigenvectors": eigenvectors[:, :n_components],
+            "all_eigenvectors": eigenvectors,
+            "band_mean": moments.mean,
+            "band_std": moments.std(),
+            "projection": projection,
+            "band_labels": [band_labels[band] for band in bands],
+            "bands": bands,
+        }
+
+    all_bands = np.arange(n_bands)
+    decompositions = []
+    for estimator in estimators:
+        decomposition_stats = decomposition(moments, estimator, all_bands)
+        if decomposition_stats is None:
+            if estimator == estimator_matrix:
+                reader.close()
+                if checkpoint is not None:
+                    checkpoint.remove()
+                return False, False
+            continue
+        # the components of the first estimator keep the names pc_N.tif
+        decomposition_stats["prefix"] = "pc" if estimator == estimator_matrix else f"pc_{estimator.lower()}"
+        decompositions.append(decomposition_stats)
+    # the single-date PCAs from the sub-matrices of the periods
+    for period, bands in periods.items():
+        decomposition_stats = decomposition(moments.subset(bands), estimator_matrix, bands)
+        if decomposition_stats is not None:
+            decomposition_stats["period"] = period
+            decomposition_stats["period_expressions"] = period_expressions[period] or None
+            decomposition_stats["prefix"] = f"pc_{period.lower()}"
+            decompositions.append(decomposition_stats)
+
+    band_mean = moments.mean
+    # all the components of all the decompositions are projected at once
+    projection = np.hstack([decomposition_stats["projection"] for decomposition_stats in decompositions])
+    # standard deviation of all the components, it sets the scale of the Int16 outputs
+    covariance = moments.covariance()
+    for decomposition_stats in decompositions:
+        bands = decomposition_stats["bands"]
+        all_eigenvectors = decomposition_stats["all_eigenvectors"]
+        decomposition_stats["all_component_std"] = np.sqrt(
+            np.maximum(np.diag(all_eigenvectors.T @ covariance[np.ix_(bands, bands)] @ all_eigenvectors), 0)
+        )
+        n_components = decomposition_stats["projection"].shape[1]
+        decomposition_stats["component_std"] = decomposition_stats["all_component_std"][:n_components]
+
+    if virtual:
+        reader.close()
+        if checkpoint is not None:
+            checkpoint.remove()
+        return pca_statistics(
+            decompositions,
+            write_virtual_decompositions(
+                A, B, decompositions, moments, band_labels, out_dir, nodata, band_list, derived_input, expressions
+            ),
+            moments,
+            band_labels,
+            derived_input,
+            expressions,
+        )
+
+    ########
+    # projection pass: save the principal components separated in tif images
+
+    def project(block):
+        window, data = block
+        # empty block, left sparse in the outputs
+        if data is None:
+            return window, None
+        try:
+            variables, mask = block_variables(data, nodata, derived_input, n_bands_A, band_math)
+            if mask is not None and mask.all():
+                return window, None
+            flat_dims = variables.reshape((n_bands, -1))
+            pc = (projection.T @ (flat_dims - band_mean[:, None])).astype(np.float32)
+            if mask is not None:
+                pc[:, mask.ravel()] = nodata
+            return window, pc.reshape((projection.shape[1], *data.shape[1:]))
+        finally:
+            buffers.release(data)
+
+    writers = [
+        ComponentWriter(
+            out_dir if checkpoint is None else checkpoint.output_dir,
+            stats["projection"].shape[1],
+            reader,
+            nodata,
+            prefix=stats["prefix"],
+            precision=precision,
+            component_std=stats["component_std"],
+            update=checkpoint is not None,
+        )
+        for stats in decompositions
+    ]
+    # components of each writer in the projection
+    splits = np.cumsum([0] + [stats["projection"].shape[1] for stats in decompositions])
+
+    def write(window, components):
+        for idx, writer in enumerate(writers):
+            writer.write(window, None if components is None else components[splits[idx] : splits[idx + 1]])
+        if checkpoint is not None and checkpoint.due():
+            for writer in writers:
+                writer.flush()
+            checkpoint.save("projection", window[1] + window[3], moments)
+
+    def projected(window):
+        return checkpoint is not None and checkpoint.done("projection", window)
+
+    try:
+        run_pipeline(
+            reader.blocks(block_size, buffers, nodata, skip=projected if checkpoint else None),
+            project,
+            lambda _, block_pc: write(*block_pc),
+            n_threads,
+            queue_depth,
+        )
+    finally:
+        files = [writer.close() for writer in writers]
+        reader.close()
+    if checkpoint is not None:
+        files = [checkpoint.move_outputs(pca_files, out_dir) for pca_files in files]
+        checkpoint.remove()
+
+    # compute the pyramids for each pc image
+    for pca_files in files:
+        build_overviews(pca_files)
+
+    return pca_statistics(decompositions, files, moments, band_labels, derived_input, expressions)
+
+
+def full_eigenvectors(decomposition_stats, n_bands):
+    """Eigenvectors of the decomposition over all the variables, with the rows
+    of the bands not used by it (the other period) in zero
+
+    :return: the eigenvectors of the components selected and of all of them
+    """
+    all_eigenvectors = np.zeros((n_bands, decomposition_stats["all_eigenvectors"].shape[1]))
+    all_eigenvectors[decomposition_stats["bands"]] = decomposition_stats["all_eigenvectors"]
+    return decomposition_stats["projection"], all_eigenvectors
+
+
+def pca_statistics(decompositions, files, moments, band_labels, derived_input=None, expressions=None):
+    """Statistics of the first decomposition with the ones of the others in
+    "alternate" and "periods", see pca()
+
+    The statistics of all of them are over all the variables of the PCA, the
+    transform saved from a single-date PCA applies to the same stack or, with
+    its "period_bands" and "period_expressions", to an image of that date alone.
+
+    :return: pca files list and statistics of the first decomposition
+    """
+    all_stats = []
+    for decomposition_stats, pca_files in zip(decompositions, files, strict=True):
+        eigenvectors, all_eigenvectors = full_eigenvectors(decomposition_stats, len(band_labels))
+        pca_stats = {}
+        pca_stats["estimator"] = decomposition_stats["estimator"]
+        pca_stats["eigenvals"] = decomposition_stats["eigenvals"]
+        pca_stats["eigenvals_%"] = decomposition_stats["eigenvals"] * 100 / len(decomposition_stats["band_labels"])
+        pca_stats["eigenvectors"] = eigenvectors
+        pca_stats["all_eigenvectors"] = all_eigenvectors
+        pca_stats["band_labels"] = band_labels
+        # the transform to apply the same components to other images (see core.transform)
+        pca_stats["band_mean"] = moments.mean
+        pca_stats["band_std"] = moments.std()
+        pca_stats["component_std"] = decomposition_stats["component_std"]
+        pca_stats["all_component_std"] = decomposition_stats["all_component_std"]
+        pca_stats["derived_input"] = derived_input
+        pca_stats["expressions"] = expressions or None
+        pca_stats["pca_files"] = pca_files
+        if decomposition_stats.get("period") is not None:
+            pca_stats["period_bands"] = decomposition_stats["bands"]
+            pca_stats["period_expressions"] = decomposition_stats["period_expressions"]
+        all_stats.append((decomposition_stats.get("period"), pca_stats))
+
+    pca_stats = all_stats[0][1]
+    for period, stats in all_stats[1:]:
+        if period is None:
+            pca_stats["alternate"] = stats
+        else:
+            pca_stats.setdefault("periods", {})[period] = stats
+
+    return files[0], pca_stats
+
+
+def write_virtual_decompositions(
+    A, B, decompositions, moments, band_labels, out_dir, nodata, band_list=None, derived_input=None, expressions=None
+):
+    """Transform of each decomposition over all the variables (with the rows
+    of the bands not used in zero) and its virtual components
+
+    :return: the VRT files of each decomposition
+    """
+    from pca4cd.core.transform import save_transform
+    from pca4cd.core.virtual import write_virtual_components
+
+    files = []
+    for stats in decompositions:
+        eigenvectors, all_eigenvectors = full_eigenvectors(stats, len(band_labels))
+        transform_file = Path(out_dir) / f"{stats['prefix']}_transform.json"
+        save_transform(
+            {
+                "estimator": stats["estimator"],
+                "band_labels": band_labels,
+                "derived_input": derived_input,
+                "expressions": expressions or None,
+                "band_mean": moments.mean,
+                "band_std": moments.std(),
+                "eigenvals": stats["eigenvals"],
+                "eigenvectors": eigenvectors,
+                "all_eigenvectors": all_eigenvectors,
+                "component_std": stats["component_std"],
+                "all_component_std": stats["all_component_std"],
+            },
+            transform_file,
+        )
+        files.append(write_virtual_components(A, B, transform_file, out_dir, nodata, band_list, stats["prefix"]))
+    return files
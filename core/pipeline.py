@@ -0,0 +1,120 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# end of stream marker between stages
+_DONE = object()
+
+
+def run_pipeline(source, compute, sink, n_workers, queue_depth=2):
+    """Run a staged block pipeline: a prefetching reader thread, a pool of
+    compute workers and a dedicated ordered writer thread, connected by
+    bounded queues.
+
+    The workers are a concurrent.futures thread pool, plain NumPy and GDAL
+    calls release the GIL (BLAS, decoding), so the blocks are computed in
+    parallel without any task graph nor scheduler overhead.
+
+    The reader blocks when the queues are full (backpressure), so at most
+    `n_workers + 2 * queue_depth` blocks are alive at the same time whatever
+    the size of the image.
+
+    :param source: iterable of blocks, it is consumed in the reader thread
+        (all the reads of the source happen in that thread)
+    :param compute: function applied to each block in the worker threads
+    :param sink: function called as sink(index, result) in the writer thread,
+        always in the same order as the source
+    :param n_workers: number of compute worker threads
+    :param queue_depth: number of blocks waiting between two stages
+    """
+    n_workers = max(1, int(n_workers))
+    queue_depth = max(1, int(queue_depth))
+    # futures of the blocks in the source order
+    write_queue = queue.Queue(maxsize=n_workers + queue_depth)
+    # limits the blocks in flight, also those computed waiting for the writer
+    in_flight = threading.BoundedSemaphore(n_workers + 2 * queue_depth)
+    abort = threading.Event()
+    errors = []
+
+    def put(target_queue, item):
+        while not abort.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(source_queue):
+        while not abort.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def fail(err):
+        errors.append(err)
+        abort.set()
+
+    def reader(executor):
+        try:
+            for block in source:
+                while not in_flight.acquire(timeout=0.1):
+                    if abort.is_set():
+                        return
+                if not put(write_queue, executor.submit(compute, block)):
+                    return
+        except Exception as err:
+            fail(err)
+        finally:
+            put(write_queue, _DONE)
+
+    def writer():
+        index = 0
+        try:
+            while True:
+                future = get(write_queue)
+                if future is _DONE:
+                    return
+                # write in the source order
+                sink(index, future.result())
+                index += 1
+                in_flight.release()
+        except Exception as err:
+            fail(err)
+
+    with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="pca4cd-worker") as executor:
+        threads = [
+            threading.Thread(target=reader, args=(executor,), name="pca4cd-reader", daemon=True),
+            threading.Thread(target=writer, name="pca4cd-writer", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,106 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import hashlib
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+# free space to keep in the scratch disk after the staging and the outputs
+SCRATCH_RESERVE = 1024**3
+
+
+class StagedStack:
+    """Decoded float32 copy of the input stack, memory mapped in the scratch
+    directory with shape (bands, rows, cols)
+
+    It is filled by the reader while the first pass decodes the inputs, then
+    the next passes (and the next runs with the same inputs in the session)
+    read it through the memory map without decoding the inputs again.
+    """
+
+    def __init__(self, path, shape):
+        self.path = Path(path)
+        self.complete_flag = self.path.with_suffix(".complete")
+        self.complete = self.path.is_file() and self.complete_flag.is_file()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.stack = np.memmap(self.path, dtype=np.float32, mode="r+" if self.complete else "w+", shape=shape)
+
+    def write(self, window, data):
+        """Write the block of all the bands in the window"""
+        xoff, yoff, xsize, ysize = window
+        self.stack[:, yoff : yoff + ysize, xoff : xoff + xsize] = data
+
+    def set_complete(self):
+        self.stack.flush()
+        self.complete_flag.touch()
+        self.complete = True
+
+    def remove(self):
+        self.stack = None
+        self.complete_flag.unlink(missing_ok=True)
+        self.path.unlink(missing_ok=True)
+
+
+def staging_key(A, B=None, band_labels=None):
+    """Key of the inputs for the staging file, it changes if the inputs are
+    modified or if other bands are selected
+    """
+    key = hashlib.sha1()
+    for file_path in (A, B):
+        if file_path:
+            stat = Path(file_path).stat()
+            key.update(f"{Path(file_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    if band_labels is not None:
+        key.update(",".join(band_labels).encode())
+    return key.hexdigest()[:16]
+
+
+def stage_inputs(reader, A, B, scratch_dir, extra_bytes=0):
+    """Staging store for the inputs of the reader, sized against the free
+    space of the scratch directory
+
+    The inputs that are already memory mapped (uncompressed and contiguous)
+    are not staged, there is nothing to save decoding them.
+
+    :param reader: StackReader of the inputs
+    :param A: first input raster data
+    :param B: second input raster data or None
+    :param scratch_dir: directory of the staging files, it is removed with the
+        temporary files of the session
+    :param extra_bytes: bytes that the run writes in the same disk (the outputs)
+    :return: StagedStack or None if it is not needed or there is no space
+    """
+    if all(memmap is not None for memmap in reader.memmaps):
+        return None
+
+    scratch_dir = Path(scratch_dir)
+    shape = (reader.n_bands, reader.y_size, reader.x_size)
+    staged_file = scratch_dir / f"stack_{staging_key(A, B, reader.band_labels)}.f32"
+    if staged_file.is_file() and staged_file.with_suffix(".complete").is_file():
+        return StagedStack(staged_file, shape)
+
+    staging_bytes = int(np.prod(shape)) * 4
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    free_bytes = shutil.disk_usage(scratch_dir).free
+    if staging_bytes + extra_bytes + SCRATCH_RESERVE > free_bytes:
+        return None
+    return StagedStack(staged_file, shape)
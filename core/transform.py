@@ -0,0 +1,243 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import json
+
+import numpy as np
+
+from pca4cd.core.band_math import open_stack, stack_variables
+from pca4cd.core.block_io import (
+    BlockBuffers,
+    ComponentWriter,
+    block_variables,
+    build_overviews,
+)
+from pca4cd.core.gdal_profile import gdal_config_options
+from pca4cd.core.pca_numpy_gdal import profile_options
+from pca4cd.core.pipeline import run_pipeline
+from pca4cd.utils.system_utils import wait_process
+
+# version of the format of the transform files
+TRANSFORM_VERSION = 1
+
+
+def save_transform(pca_stats, file_path):
+    """Save the transform of a PCA (eigenvectors, band means and standard
+    deviations) in a JSON file to apply it to other images, with the
+    eigenvectors of all the components, also the ones not projected
+
+    :param pca_stats: statistics returned by pca()
+    :param file_path: JSON file to write
+    """
+    transform = {
+        "version": TRANSFORM_VERSION,
+        "estimator": pca_stats["estimator"],
+        "band_labels": list(pca_stats["band_labels"]),
+        "derived_input": pca_stats.get("derived_input"),
+        "expressions": pca_stats.get("expressions"),
+        "band_mean": np.asarray(pca_stats["band_mean"]).tolist(),
+        "band_std": np.asarray(pca_stats["band_std"]).tolist(),
+        "eigenvals": np.asarray(pca_stats["eigenvals"]).tolist(),
+        "eigenvectors": np.asarray(pca_stats.get("all_eigenvectors", pca_stats["eigenvectors"])).tolist(),
+        "component_std": np.asarray(pca_stats.get("all_component_std", pca_stats["component_std"])).tolist(),
+        # the components projected by the PCA, the ones applied by default
+        "n_components": int(np.shape(pca_stats["eigenvectors"])[1]),
+        # variables of the single-date PCAs, to apply them to that date alone
+        "period_bands": None if pca_stats.get("period_bands") is None else list(map(int, pca_stats["period_bands"])),
+        "period_expressions": pca_stats.get("period_expressions"),
+    }
+    with open(file_path, "w") as transform_file:
+        json.dump(transform, transform_file, indent=2)
+
+
+def load_transform(file_path):
+    """Load a transform file saved with save_transform
+
+    :return: dict with the transform, the vectors and matrices as arrays
+    """
+    with open(file_path) as transform_file:
+        transform = json.load(transform_file)
+    if transform.get("version") != TRANSFORM_VERSION:
+        raise ValueError(f"Unsupported transform file version: {transform.get('version')}")
+    for key in ["band_mean", "band_std", "eigenvals", "eigenvectors", "component_std"]:
+        transform[key] = np.asarray(transform[key], dtype=np.float64)
+    transform.setdefault("n_components", transform["eigenvectors"].shape[1])
+    transform.setdefault("expressions", None)
+    transform.setdefault("period_bands", None)
+    transform.setdefault("period_expressions", None)
+    return transform
+
+
+def project_block(data, band_mean, eigenvectors, nodata, derived_input=None, n_bands_A=None, band_math=None):
+    """Components of a block of the stack with the eigenvectors applied to
+    the variables centered with the band means
+
+    :param data: block of the stack with shape (bands, rows, cols)
+    :param derived_input: derived variables of the block (see DERIVED_INPUTS) or None
+    :param n_bands_A: number of bands of A in the stack, for the derived variables
+    :param band_math: BandMath of the expressions of the variables or None
+    :return: components with shape (n_pc, rows, cols) with nodata in the masked
+        pixels, or None if all the pixels are masked
+    """
+    variables, mask = block_variables(data, nodata, derived_input, n_bands_A, band_math)
+    if mask is not None and mask.all():
+        return None
+    pc = (eigenvectors.T @ (variables.reshape((len(band_mean), -1)) - band_mean[:, None])).astype(np.float32)
+    if mask is not None:
+        pc[:, mask.ravel()] = nodata
+    return pc.reshape((eigenvectors.shape[1], *data.shape[1:]))
+
+
+@wait_process
+def apply_transform(
+    A,
+    B,
+    transform_file,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata=None,
+    queue_depth=2,
+    gdal_profile="Balanced",
+    memory_budget=4096,
+    band_list=None,
+    precision="Float32",
+    components=None,
+):
+    """Principal components of A (and B) with a saved transform, in a single
+    streaming projection pass without estimating the moments again
+
+    The components are projected as in pca(): the eigenvectors of the
+    transform applied to the bands centered with the means of the transform.
+
+    :param A: first input raster data (fists period)
+    :param B: second input raster data (second period) or None
+    :param transform_file: JSON file saved with save_transform
+    :param out_dir: directory to save the outputs
+    :param n_threads: number of compute workers
+    :param block_size: blocks of about block_size**2 pixels
+    :param nodata: nodata value of the inputs or None
+    :param queue_depth: number of blocks waiting between the pipeline stages
+    :param gdal_profile: GDAL performance profile set during the run (see GDAL_PROFILES)
+    :param memory_budget: memory budget of the run in MB, used to size the GDAL profile
+    :param band_list: band numbers in the stack of A and B to use, see pca(),
+        the same number of bands of the transform
+    :param precision: storage of the components, see pca()
+    :param components: numbers (starting at 1) of the components to project,
+        the ones projected by the PCA of the transform by default, the others
+        are available on demand (e.g. after an automatic number of components)
+    :return: pca files list and statistics (of the transform)
+    """
+    transform = load_transform(transform_file)
+    gdal_options = profile_options(A, B, n_threads, block_size, queue_depth, gdal_profile, memory_budget, band_list)
+    with gdal_config_options(gdal_options):
+        return stream_transform(
+            A, B, transform, out_dir, n_threads, block_size, nodata, queue_depth, band_list, precision, components
+        )
+
+
+def stream_transform(
+    A,
+    B,
+    transform,
+    out_dir,
+    n_threads,
+    block_size,
+    nodata,
+    queue_depth,
+    band_list=None,
+    precision="Float32",
+    components=None,
+):
+    """The projection pass of a saved transform, see apply_transform()"""
+    # a single-date transform applied to an image of its date alone, with only
+    # its variables and expressions (the ones of the other date need B)
+    period_bands = transform["period_bands"] if not B else None
+    expressions = transform["expressions"] if period_bands is None else transform["period_expressions"]
+    reader, band_math = open_stack(A, B, band_list, expressions)
+    derived_input = transform["derived_input"]
+    try:
+        n_bands_A, n_bands, _ = stack_variables(reader, band_math, derived_input)
+    except ValueError:
+        reader.close()
+        raise
+    band_mean, band_std, eigenvectors = transform["band_mean"], transform["band_std"], transform["eigenvectors"]
+    band_labels = transform["band_labels"]
+    if period_bands is not None:
+        band_mean, band_std, eigenvectors = band_mean[period_bands], band_std[period_bands], eigenvectors[period_bands]
+        band_labels = [band_labels[band] for band in period_bands]
+    if n_bands != len(band_mean):
+        reader.close()
+        raise ValueError(f"The transform is for {len(band_mean)} bands but the inputs have {n_bands} bands")
+    if components is None:
+        components = range(1, transform["n_components"] + 1)
+    components = list(components)
+    if not components or min(components) < 1 or max(components) > eigenvectors.shape[1]:
+        reader.close()
+        raise ValueError(f"The components to project must be between 1 and {eigenvectors.shape[1]}")
+    eigenvectors = eigenvectors[:, np.array(components) - 1]
+    component_std = transform["component_std"][np.array(components) - 1]
+    n_pc = len(components)
+    buffers = BlockBuffers(reader.block_shape(block_size))
+
+    def project(block):
+        window, data = block
+        if data is None:
+            return window, None
+        try:
+            return window, project_block(data, band_mean, eigenvectors, nodata, derived_input, n_bands_A, band_math)
+        finally:
+            buffers.release(data)
+
+    writer = ComponentWriter(
+        out_dir, n_pc, reader, nodata, precision=precision, component_std=component_std, numbers=components
+    )
+    try:
+        run_pipeline(
+            reader.blocks(block_size, buffers, nodata),
+            project,
+            lambda _, block_pc: writer.write(*block_pc),
+            n_threads,
+            queue_depth,
+        )
+    finally:
+        pca_files = writer.close()
+        reader.close()
+
+    # compute the pyramids for each pc image
+    build_overviews(pca_files)
+
+    ########
+    # pca statistics of the transform
+    pca_stats = {}
+    pca_stats["estimator"] = transform["estimator"]
+    pca_stats["eigenvals"] = transform["eigenvals"]
+    pca_stats["eigenvals_%"] = transform["eigenvals"] * 100 / n_bands
+    pca_stats["eigenvectors"] = eigenvectors
+    pca_stats["band_labels"] = band_labels
+    pca_stats["band_mean"] = band_mean
+    pca_stats["band_std"] = band_std
+    pca_stats["component_std"] = component_std
+    pca_stats["derived_input"] = derived_input
+    pca_stats["expressions"] = expressions
+    pca_stats["component_labels"] = [f"Principal Component {number}" for number in components]
+    pca_stats["pca_files"] = pca_files
+
+    return pca_files, pca_stats
@@ -0,0 +1,224 @@
+"""
+/***************************************************************************
+ PCA4CD
+                                 A QGIS plugin
+ Principal components analysis for change detection
+                              -------------------
+        copyright            : (C) 2018-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+ Virtual components: VRT files with a derived band that projects the input
+ bands with a saved transform only for the windows requested (the tiles
+ rendered by QGIS), materialized in a GeoTIFF when the whole component is
+ needed (statistics, detection).
+"""
+
+import functools
+import os
+import threading
+import xml.etree.ElementTree as ET
+from multiprocessing import cpu_count
+from pathlib import Path
+
+import numpy as np
+from osgeo import gdal
+
+from pca4cd.core.band_math import open_stack, stack_variables
+from pca4cd.core.transform import load_transform, project_block, stream_transform
+
+# pixel function of the derived bands, run by GDAL in this process
+PIXEL_FUNCTION = f"{__name__}.project_component"
+# one lock per virtual component, it is materialized once even if it is
+# requested by several threads (the background publication and the analysis)
+_materialize_locks = {}
+_materialize_locks_lock = threading.Lock()
+
+
+def enable_pixel_function():
+    """Trust this module to run the pixel function of the virtual components
+    (GDAL_VRT_ENABLE_PYTHON=TRUSTED_MODULES, the GDAL default)
+    """
+    trusted = (gdal.GetConfigOption("GDAL_VRT_PYTHON_TRUSTED_MODULES") or "").split(",")
+    trusted = [module for module in trusted if module]
+    if __name__ not in trusted:
+        gdal.SetConfigOption("GDAL_VRT_PYTHON_TRUSTED_MODULES", ",".join([*trusted, __name__]))
+
+
+def source_bands(A, B=None, band_list=None, expressions=None):
+    """(file, band number) of the bands read for the variables, in the order
+    of the blocks of open_stack()
+    """
+    reader, band_math = open_stack(A, B, band_list, expressions)
+    n_bands_A = reader.datasets[0].RasterCount
+    n_stack = sum(src_ds.RasterCount for src_ds in reader.datasets)
+    reader.close()
+    if band_math is not None:
+        read_band_list = band_math.read_band_list(band_list, n_stack)
+    else:
+        read_band_list = range(1, n_stack + 1) if band_list is None else sorted(set(band_list))
+    return [(A, number) if number <= n_bands_A else (B, number - n_bands_A) for number in read_band_list]
+
+
+def write_virtual_components(A, B, transform_file, out_dir, nodata=None, band_list=None, prefix="pc"):
+    """Write a virtual component (VRT) for each component of the transform
+    applied by default, nothing is projected until the VRT is read
+
+    :param transform_file: JSON file saved with save_transform
+    :return: the VRT files, pc_N.vrt
+    """
+    enable_pixel_function()
+    transform = load_transform(transform_file)
+    reader, _ = open_stack(A, B, band_list, transform["expressions"])
+    x_size, y_size = reader.x_size, reader.y_size
+    geotransform, projection = reader.geotransform, reader.projection
+    reader.close()
+    sources = source_bands(A, B, band_list, transform["expressions"])
+    vrt_files = []
+    for number in range(1, transform["n_components"] + 1):
+        vrt = ET.Element("VRTDataset", rasterXSize=str(x_size), rasterYSize=str(y_size))
+        if projection:
+            ET.SubElement(vrt, "SRS").text = projection
+        if geotransform is not None:
+            ET.SubElement(vrt, "GeoTransform").text = ", ".join(repr(float(value)) for value in geotransform)
+        band = ET.SubElement(vrt, "VRTRasterBand", dataType="Float32", band="1", subClass="VRTDerivedRasterBand")
+        if nodata is not None:
+            ET.SubElement(band, "NoDataValue").text = repr(float(nodata))
+        ET.SubElement(band, "PixelFunctionType").text = PIXEL_FUNCTION
+        ET.SubElement(band, "PixelFunctionLanguage").text = "Python"
+        ET.SubElement(
+            band,
+            "PixelFunctionArguments",
+            transform=str(Path(transform_file).resolve()),
+            component=str(number),
+            A=str(A),
+            B=str(B) if B else "",
+            band_list=",".join(str(band) for band in band_list) if band_list else "",
+            nodata="" if nodata is None else repr(float(nodata)),
+        )
+        ET.SubElement(band, "SourceTransferType").text = "Float64"
+        for file_path, band_number in sources:
+            source = ET.SubElement(band, "SimpleSource")
+            ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = str(file_path)
+            ET.SubElement(source, "SourceBand").text = str(band_number)
+        vrt_file = Path(out_dir) / f"{prefix}_{number}.vrt"
+        ET.ElementTree(vrt).write(vrt_file, encoding="utf-8")
+        vrt_files.append(vrt_file)
+    return vrt_files
+
+
+def virtual_component(file_path):
+    """Arguments of the virtual component (see write_virtual_components), or
+    None if the file is not a virtual component
+    """
+    if Path(file_path).suffix.lower() != ".vrt" or not Path(file_path).is_file():
+        return None
+    band = ET.parse(file_path).getroot().find("VRTRasterBand")
+    if band is None or band.findtext("PixelFunctionType") != PIXEL_FUNCTION:
+        return None
+    return dict(band.find("PixelFunctionArguments").attrib)
+
+
+@functools.lru_cache(maxsize=32)
+def component_setup(transform_file, transform_version, component, A, B, band_list, nodata):
+    """Projection of a virtual component, from the arguments of its VRT
+
+    :param transform_version: modification time and size of the transform
+        file, the runs write the same file and the cached setup of a previous
+        run must not be used
+    """
+    transform = load_transform(transform_file)
+    band_list = [int(number) for number in band_list.split(",")] if band_list else None
+    reader, band_math = open_stack(A, B or None, band_list, transform["expressions"])
+    n_bands_A, _, _ = stack_variables(reader, band_math, transform["derived_input"])
+    reader.close()
+    eigenvector = transform["eigenvectors"][:, [int(component) - 1]]
+    nodata = float(nodata) if nodata else None
+    return transform["band_mean"], eigenvector, transform["derived_input"], n_bands_A, band_math, nodata
+
+
+def project_component(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt, **kwargs):
+    """Pixel function of the virtual components: the component of the window
+    requested projected from the blocks of the sources (the bands read)
+    """
+    # the arguments of the VRT are passed as bytes
+    args = {key: value.decode() if isinstance(value, bytes) else value for key, value in kwargs.items()}
+    stat = os.stat(args["transform"])
+    band_mean, eigenvector, derived_input, n_bands_A, band_math, nodata = component_setup(
+        args["transform"],
+        (stat.st_mtime_ns, stat.st_size),
+        args["component"],
+        args["A"],
+        args["B"],
+        args["band_list"],
+        args["nodata"],
+    )
+    pc = project_block(np.stack(in_ar), band_mean, eigenvector, nodata, derived_input, n_bands_A, band_math)
+    if pc is None:
+        out_ar[:] = np.nan if nodata is None else nodata
+    else:
+        out_ar[:] = pc[0]
+
+
+def virtual_statistics(file_path):
+    """Mean and standard deviation of the virtual component from the moments
+    of the PCA (the components are centered), without reading it
+    """
+    args = virtual_component(file_path)
+    component_std = load_transform(args["transform"])["component_std"]
+    return 0.0, float(component_std[int(args["component"]) - 1])
+
+
+def materialize_component(file_path, n_threads=None, block_size=1024):
+    """Project the whole virtual component in a GeoTIFF (once, it is reused)
+    in a directory next to the VRT, with the streaming pass of apply_transform()
+
+    :return: the GeoTIFF of the component, or file_path if it is not virtual
+    """
+    args = virtual_component(file_path)
+    if args is None:
+        return file_path
+    out_dir = Path(file_path).with_suffix("")
+    pc_file = out_dir / f"pc_{args['component']}.tif"
+    with _materialize_locks_lock:
+        lock = _materialize_locks.setdefault(str(Path(file_path).resolve()), threading.Lock())
+    with lock:
+        if pc_file.is_file() and os.path.getmtime(pc_file) >= os.path.getmtime(file_path):
+            return pc_file
+        out_dir.mkdir(parents=True, exist_ok=True)
+        pca_files, _ = stream_transform(
+            args["A"],
+            args["B"] or None,
+            load_transform(args["transform"]),
+            out_dir,
+            n_threads or cpu_count(),
+            block_size,
+            float(args["nodata"]) if args["nodata"] else None,
+            queue_depth=2,
+            band_list=[int(number) for number in args["band_list"].split(",")] if args["band_list"] else None,
+            components=[int(args["component"])],
+        )
+    return pca_files[0]
+
+
+def materialize_components(file_paths, n_threads=None, block_size=1024, is_canceled=None):
+    """Materialize the virtual components one at a time in their order (PC1
+    first), each one is published (yielded) as soon as it is written with its
+    statistics and overviews, the other files are yielded as they are
+
+    :param is_canceled: function that returns True to stop before the next component
+    :return: generator of the index in file_paths and the file of each component
+    """
+    for idx, file_path in enumerate(file_paths):
+        if is_canceled is not None and is_canceled():
+            return
+        yield idx, materialize_component(file_path, n_threads, block_size)
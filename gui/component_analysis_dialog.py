@@ -20,7 +20,6 @@
 
 import os
 import platform
-from multiprocessing import cpu_count
 from pathlib import Path
 
 import numpy as np
@@ -33,6 +32,8 @@ from qgis.PyQt.QtCore import Qt, QTimer, pyqtSlot
 from qgis.PyQt.QtGui import QColor
 from qgis.PyQt.QtWidgets import QWidget
 
+from pca4cd.core.block_io import read_band, scaled_values, stored_histogram, stored_statistics
+from pca4cd.core.virtual import materialize_component
 from pca4cd.utils.others_utils import clip_raster_with_shape
 from pca4cd.utils.qgis_utils import apply_symbology, get_file_path_of_layer, load_layer
 from pca4cd.utils.system_utils import block_signals_to, wait_process
@@ -241,18 +242,20 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
         self.linear_region.sigRegionChanged.connect(self.update_region_from_plot)
         self.RangeChangeFrom.valueChanged.connect(self.update_region_from_values)
         self.RangeChangeTo.valueChanged.connect(self.update_region_from_values)
-        # statistics for current principal component
-        self.pc_gdal_ds = gdal.Open(str(get_file_path_of_layer(self.pc_layer)), gdal.GA_ReadOnly)
+        # statistics for current principal component, the virtual ones are computed in full once
+        pc_file = materialize_component(get_file_path_of_layer(self.pc_layer))
+        self.pc_gdal_ds = gdal.Open(str(pc_file), gdal.GA_ReadOnly)
         if self.pc_gdal_ds is None:
             raise RuntimeError(f"Could not open raster file for component: {self.pc_layer.name()}")
-        self.pc_data = self.pc_gdal_ds.GetRasterBand(1).ReadAsArray()
-        self.pc_data_flat = self.pc_data.flatten()
-        self.pc_data_flat = self.pc_data_flat[~np.isnan(self.pc_data_flat)]
+        # the data of the component is read only when it is needed (see pc_data)
+        self._pc_data = None
+        self._pc_data_flat = None
         self.stats_pc = None  # store stats done for principal components
-        from pca4cd.gui.main_analysis_dialog import MainAnalysisDialog
-
-        if MainAnalysisDialog.nodata is not None:
-            self.pc_data_flat = np.delete(self.pc_data_flat, np.where(self.pc_data_flat == MainAnalysisDialog.nodata))
+        # the statistics and histogram stored by the engine while writing the component, without computing them
+        stored_stats = stored_statistics(self.pc_gdal_ds.GetRasterBand(1))
+        if stored_stats is not None and "p50" in stored_stats:
+            self.stats_pc = tuple(stored_stats[key] for key in ["min", "max", "std", "p25", "p50", "p75"])
+        self.pc_histogram = stored_histogram(self.pc_gdal_ds.GetRasterBand(1))
         self.set_statistics(stats_for=self.pc_name)
         # init aoi data
         self.aoi_data = np.array([np.nan])
@@ -272,7 +275,29 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
         # release GDAL handles before dropping references
         self.pc_gdal_ds = None
         self.driver_detection_layer = None
-        del self.pc_data, self.pc_data_flat, self.aoi_data, self.HistogramPlot, self.hist_data, self.hist_data_pc
+        del self._pc_data, self._pc_data_flat, self.aoi_data, self.HistogramPlot, self.hist_data, self.hist_data_pc
+
+    @property
+    def pc_data(self):
+        """Data of the component, memory mapped when the component file allows
+        it (the pages are read and cached by the OS)
+        """
+        if self._pc_data is None:
+            self._pc_data = read_band(self.pc_gdal_ds)
+        return self._pc_data
+
+    @property
+    def pc_data_flat(self):
+        """Valid values of the component, for the statistics and histograms not stored"""
+        if self._pc_data_flat is None:
+            from pca4cd.gui.main_analysis_dialog import MainAnalysisDialog
+
+            pc_data_flat = self.pc_data.ravel()
+            pc_data_flat = pc_data_flat[~np.isnan(pc_data_flat)]
+            if MainAnalysisDialog.nodata is not None:
+                pc_data_flat = pc_data_flat[pc_data_flat != MainAnalysisDialog.nodata]
+            self._pc_data_flat = pc_data_flat
+        return self._pc_data_flat
 
     @pyqtSlot()
     def show(self):
@@ -319,8 +344,6 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
     @pyqtSlot()
     @wait_process
     def generate_detection_layer(self):
-        from dask import array as da
-
         from pca4cd.pca4cd import PCA4CD as pca4cd
 
         detection_from = self.RangeChangeFrom.value()
@@ -328,16 +351,9 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
         output_change_layer = Path(pca4cd.tmp_dir, self.pc_layer.name() + "_detection.tif")
 
         # compute the detection layer between range values
-        da_pc = da.from_array(self.pc_data, chunks=(2000, 2000))
-
-        def calc(block, range_from, range_to):
-            result = np.zeros_like(block)
-            result[(block >= range_from) & (block <= range_to) & (block != 0)] = 1
-            return result
-
-        # process
-        map_blocks = da.map_blocks(calc, da_pc, range_from=detection_from, range_to=detection_to, dtype=np.int8)
-        detection_layer_ds = map_blocks.compute(scheduler="threads", num_workers=cpu_count())
+        pc_data = self.pc_data
+        detection_layer_ds = (pc_data >= detection_from) & (pc_data <= detection_to) & (pc_data != 0)
+        detection_layer_ds = detection_layer_ds.astype(np.int8)
         # save
         if self.driver_detection_layer is None:
             driver = gdal.GetDriverByName("GTiff")
@@ -380,8 +396,9 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
 
             with block_signals_to(self.QCBox_StatsLayer):
                 self.QCBox_StatsLayer.setCurrentIndex(0)
-            self.statistics(self.pc_data_flat, MainAnalysisDialog.pca_stats)
-            self.histogram_plot(data=self.pc_data_flat)
+            # the component is read only if its statistics are not stored
+            self.statistics(self.pc_data_flat if self.stats_pc is None else None, MainAnalysisDialog.pca_stats)
+            self.histogram_plot()
         if stats_for == "Areas Of Interest":
             with block_signals_to(self.QCBox_StatsLayer):
                 self.QCBox_StatsLayer.setCurrentIndex(1)
@@ -390,8 +407,6 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
 
     @wait_process
     def statistics(self, data, pca_stats=None):
-        from dask import array as da
-
         # set headers
         if pca_stats:  # for pca
             if pca_stats["eigenvals"] is not None:
@@ -423,13 +438,11 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
         if self.QCBox_StatsLayer.currentText() == self.pc_name and self.stats_pc is not None:
             min, max, std, p25, p50, p75 = self.stats_pc
         else:
-            da_data = da.from_array(data, chunks=(8000000,))
-            min = da.min(da_data).compute()
-            max = da.max(da_data).compute()
-            std = da.std(da_data).compute()
-            p25 = float(da.percentile(da_data, 25).compute().item())
-            p50 = float(da.percentile(da_data, 50).compute().item())
-            p75 = float(da.percentile(da_data, 75).compute().item())
+            min = np.min(data)
+            max = np.max(data)
+            std = np.std(data, dtype=np.float64)
+            # the three percentiles with a single partition of the data
+            p25, p50, p75 = (float(p) for p in np.percentile(data, [25, 50, 75]))
             if self.QCBox_StatsLayer.currentText() == self.pc_name:
                 self.stats_pc = (min, max, std, p25, p50, p75)
         # set in dialog
@@ -443,18 +456,16 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
     @pyqtSlot()
     @wait_process
     def histogram_plot(self, data=None, bins=None):
-        from dask import array as da
-
         # which plot
         stats_for = self.QCBox_StatsLayer.currentText()
         if stats_for == self.pc_name:
             hist_bins = self.hist_bins["pc"]
         if stats_for == "Areas Of Interest":
             hist_bins = self.hist_bins["aoi"]
-        # check and set data
+        # check and set data, the data of the component is read only if needed
         if data is not None:
             self.hist_data = data
-        if self.hist_data is None or self.hist_data.size <= 1:
+        if stats_for != self.pc_name and (self.hist_data is None or self.hist_data.size <= 1):
             self.HistogramPlot.clear()
             return
         # histogram bins
@@ -487,16 +498,21 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
 
         def _histogram(data, bins):
             bin_edges = np.histogram_bin_edges(data, bins=bins)
-            da_hist_data = da.from_array(data, chunks=(8000000,))
-            counts, edges = da.histogram(da_hist_data, bins=bin_edges)
-            return counts.compute(scheduler="threads", num_workers=cpu_count()), edges
+            return np.histogram(data, bins=bin_edges)
 
-        if stats_for == self.pc_name and set_bins in ["auto", "doane", "scott", "rice"]:
+        if stats_for == self.pc_name and set_bins == "auto" and self.pc_histogram is not None:
+            y, x = self.pc_histogram  # stored by the engine
+        elif stats_for == self.pc_name and self.pc_data_flat.size <= 1:
+            self.HistogramPlot.clear()
+            return
+        elif stats_for == self.pc_name and set_bins in ["auto", "doane", "scott", "rice"]:
             if self.hist_data_pc[set_bins] is not None:
                 y, x = self.hist_data_pc[set_bins]  # restore histogram values
             else:
-                y, x = _histogram(self.hist_data, set_bins)
+                y, x = _histogram(self.pc_data_flat, set_bins)
                 self.hist_data_pc[set_bins] = (y, x)
+        elif stats_for == self.pc_name:
+            y, x = _histogram(self.pc_data_flat, set_bins)
         else:
             y, x = _histogram(self.hist_data, set_bins)
         self.HistogramPlot.clear()
@@ -532,17 +548,21 @@ class ComponentAnalysisDialog(QWidget, FORM_CLASS):
                 self.aoi_features.addFeature(new_feature)
         # clip the raster component in AOI for get only the pixel values inside it
         pc_aoi = Path(pca4cd.tmp_dir, self.pc_layer.name() + "_clip_aoi.tif")
-        clip_raster_with_shape(self.pc_layer, self.aoi_features, str(pc_aoi), MainAnalysisDialog.nodata)
+        # clipped with the nodata of the component file, the scaled (Int16) and
+        # half float components have their own nodata value
+        pc_band = self.pc_gdal_ds.GetRasterBand(1)
+        pc_nodata = pc_band.GetNoDataValue() if pc_band.GetNoDataValue() is not None else MainAnalysisDialog.nodata
+        clip_raster_with_shape(self.pc_layer, self.aoi_features, str(pc_aoi), pc_nodata)
         dataset = gdal.Open(str(pc_aoi), gdal.GA_ReadOnly)
         if dataset is None:
             self.aoi_data = np.array([np.nan])
             return
         try:
-            self.aoi_data = dataset.GetRasterBand(1).ReadAsArray().flatten()
+            self.aoi_data = scaled_values(dataset.GetRasterBand(1).ReadAsArray(), pc_band).flatten()
         finally:
             dataset = None
-        if MainAnalysisDialog.nodata is not None and not np.isnan(MainAnalysisDialog.nodata):
-            self.aoi_data = np.delete(self.aoi_data, np.where(self.aoi_data == MainAnalysisDialog.nodata))
+        if pc_nodata is not None and not np.isnan(pc_nodata):
+            self.aoi_data = np.delete(self.aoi_data, np.where(self.aoi_data == pc_nodata))
         self.aoi_data = np.delete(self.aoi_data, np.where(np.isnan(self.aoi_data)))
         if self.aoi_data.size == 0:
             self.aoi_data = np.array([np.nan])
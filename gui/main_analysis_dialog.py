@@ -26,23 +26,53 @@ from typing import ClassVar
 
 import numpy as np
 from osgeo import gdal
-from qgis.core import Qgis, QgsContrastEnhancement, QgsSingleBandGrayRenderer
+from qgis.core import Qgis, QgsApplication, QgsContrastEnhancement, QgsSingleBandGrayRenderer, QgsTask
 from qgis.PyQt import uic
-from qgis.PyQt.QtCore import Qt, pyqtSlot
-from qgis.PyQt.QtWidgets import QDialog, QFileDialog, QGridLayout, QMessageBox
+from qgis.PyQt.QtCore import Qt, pyqtSignal, pyqtSlot
+from qgis.PyQt.QtWidgets import QDialog, QFileDialog, QGridLayout, QInputDialog, QMessageBox
 from qgis.utils import iface
 
+from pca4cd.core.block_io import read_band, stored_statistics
+from pca4cd.core.transform import apply_transform, save_transform
+from pca4cd.core.virtual import materialize_components, virtual_component, virtual_statistics
 from pca4cd.gui.layer_view_widget import LayerViewWidget
 from pca4cd.gui.merge_change_layers_dialog import MergeChangeLayersDialog
 from pca4cd.gui.pca_info_dialog import PCAInfoDialog
 from pca4cd.utils.qgis_utils import apply_symbology, get_file_path_of_layer, load_layer, unload_layer
-from pca4cd.utils.system_utils import wait_process
+from pca4cd.utils.system_utils import block_signals_to, wait_process
 
 # plugin path
 plugin_folder = os.path.dirname(os.path.dirname(__file__))
 FORM_CLASS, _ = uic.loadUiType(Path(plugin_folder, "ui", "main_analysis_dialog.ui"))
 
 
+class PublishComponentsTask(QgsTask):
+    """Materialize the virtual components in the background in their order,
+    each one is published as soon as it is written (see materialize_components)
+    """
+
+    published = pyqtSignal(int, str)
+
+    def __init__(self, pca_files, n_threads, block_size):
+        super().__init__("PCA4CD: writing the principal components", QgsTask.Flag.CanCancel)
+        self.pca_files = pca_files
+        self.n_threads = n_threads
+        self.block_size = block_size
+        self.error = None
+
+    def run(self):
+        try:
+            for idx, pc_file in materialize_components(
+                self.pca_files, self.n_threads, self.block_size, is_canceled=self.isCanceled
+            ):
+                self.setProgress(100 * (idx + 1) / len(self.pca_files))
+                self.published.emit(idx, str(pc_file))
+        except Exception as err:
+            self.error = err
+            return False
+        return not self.isCanceled()
+
+
 class MainAnalysisDialog(QDialog, FORM_CLASS):
     view_widgets: ClassVar[list] = []
     pca_layers = None
@@ -74,12 +104,34 @@ class MainAnalysisDialog(QDialog, FORM_CLASS):
         if self.layer_a is None:
             self.SavePCA.setDisabled(True)
             self.SavePCA.setToolTip("Not available if the components are loaded externally")
+        # save the transform to apply it to other images
+        self.SaveTransform.clicked.connect(self.save_transform)
+        # compute the components not projected with the transform
+        self.OtherComponents.clicked.connect(self.other_components)
+        self.set_save_transform_option()
         # show eigenvalues / eigenvectors
         self.ShowPCAInfo.clicked.connect(self.show_pca_info)
         if pca_stats is None or pca_stats.get("eigenvals") is None:
             self.ShowPCAInfo.setDisabled(True)
             self.ShowPCAInfo.setToolTip("Not available if the components are loaded externally")
         self._pca_info_dialog = None
+        # background task that publishes the virtual components, see publish_components
+        self.publish_task = None
+        # component sets of each estimator matrix and each period computed, the
+        # layers of the other sets are loaded the first time they are shown
+        self.component_sets = {}
+        if pca_stats is not None and pca_stats.get("estimator") is not None:
+            self.component_sets[pca_stats["estimator"]] = {"layers": pca_layers, "stats": pca_stats}
+            if pca_stats.get("alternate") is not None:
+                self.component_sets[pca_stats["alternate"]["estimator"]] = {
+                    "layers": None,
+                    "stats": pca_stats["alternate"],
+                }
+            for period, period_stats in pca_stats.get("periods", {}).items():
+                self.component_sets[f"{period} only"] = {"layers": None, "stats": period_stats}
+        self.QCBox_ComponentSet.addItems(list(self.component_sets))
+        self.QCBox_ComponentSet.setVisible(len(self.component_sets) > 1)
+        self.QCBox_ComponentSet.currentTextChanged.connect(self.switch_component_set)
         # merge change layer
         self.OpenMergeChangeLayers.clicked.connect(self.open_merge_change_layers)
 
@@ -134,7 +186,7 @@ class MainAnalysisDialog(QDialog, FORM_CLASS):
                 view_widget.QCBox_RenderFile.setCurrentIndex(file_index)
             if grid_columns < num_view <= len(self.pca_layers) + grid_columns:
                 view_widget.pc_id = num_view - grid_columns
-                view_widget.QLabel_ViewName.setText(f"Principal Component {view_widget.pc_id}")
+                view_widget.QLabel_ViewName.setText(self.component_label(view_widget.pc_id))
                 file_index = view_widget.QCBox_RenderFile.findText(
                     self.pca_layers[num_view - grid_columns - 1].name(), Qt.MatchFlag.MatchFixedString
                 )
@@ -157,10 +209,18 @@ class MainAnalysisDialog(QDialog, FORM_CLASS):
                 view_widget.QLabel_ViewName.setPlaceholderText("Auxiliary View")
 
         self.MsgBar.pushMessage(
-            f"{len(self.pca_layers)} principal components were generated and loaded successfully",
+            f"{len(self.pca_layers)} components were generated and loaded successfully",
             level=Qgis.MessageLevel.Success,
         )
 
+    @staticmethod
+    def component_label(pc_id):
+        """Name of the component in the views, the MAD outputs have their own labels"""
+        pca_stats = MainAnalysisDialog.pca_stats or {}
+        if pca_stats.get("component_labels"):
+            return pca_stats["component_labels"][pc_id - 1]
+        return f"Principal Component {pc_id}"
+
     def show(self):
         from pca4cd.pca4cd import PCA4CD as pca4cd
 
@@ -182,6 +242,7 @@ class MainAnalysisDialog(QDialog, FORM_CLASS):
         if reply == QMessageBox.StandardButton.No:
             return
 
+        self.cancel_publish_components()
         # clear/close components analysis
         for view_widget in MainAnalysisDialog.view_widgets:
             if view_widget.component_analysis_dialog and view_widget.component_analysis_dialog.is_opened:
@@ -212,6 +273,7 @@ class MainAnalysisDialog(QDialog, FORM_CLASS):
         if reply == QMessageBox.StandardButton.No:
             return
 
+        self.cancel_publish_components()
         # close components analysis opened
         for view_widget in MainAnalysisDialog.view_widgets:
             if view_widget.component_analysis_dialog and view_widget.component_analysis_dialog.is_opened:
@@ -230,34 +292,156 @@ class MainAnalysisDialog(QDialog, FORM_CLASS):
         if is_ok_to_close:
             super().reject()
 
+    @staticmethod
+    def component_mean_std(pc_file, nodata):
+        """Mean and standard deviation of the component: from the moments of the
+        virtual components or the statistics stored by the engine, the other
+        files are read (e.g. external components), None if all is nodata
+        """
+        if virtual_component(pc_file) is not None:
+            return virtual_statistics(pc_file)
+        src_ds = gdal.Open(str(pc_file), gdal.GA_ReadOnly)
+        if src_ds is None:
+            return None
+        stats = stored_statistics(src_ds.GetRasterBand(1))
+        if stats is not None:
+            return stats["mean"], stats["std"]
+        # memory mapped when possible, the statistics use a mask instead of copying the valid data
+        ds = read_band(src_ds).ravel()
+        # always strip NaNs; also strip the explicit nodata sentinel if set
+        valid = ~np.isnan(ds)
+        if nodata is not None and not np.isnan(nodata):
+            valid &= ds != nodata
+        if not valid.any():
+            return None
+        return np.mean(ds, where=valid, dtype=np.float64), np.std(ds, where=valid, dtype=np.float64)
+
     @wait_process
     def update_pc_style(self, nodata):
         """Update the grey style using mean+-5*std for all principal components"""
         for view_widget in MainAnalysisDialog.view_widgets:
             if view_widget.pc_id is not None:
-                src_ds = gdal.Open(str(get_file_path_of_layer(view_widget.render_widget.layer)), gdal.GA_ReadOnly)
-                if src_ds is None:
-                    continue
-                ds = src_ds.GetRasterBand(1).ReadAsArray().flatten().astype(np.float32)
-                # always strip NaNs; also strip the explicit nodata sentinel if set
-                ds = ds[~np.isnan(ds)]
-                if nodata is not None and not np.isnan(nodata):
-                    ds = ds[ds != nodata]
-                if ds.size == 0:
-                    src_ds = None
-                    continue
-                mean = np.mean(ds)
-                std = np.std(ds)
-                renderer = QgsSingleBandGrayRenderer(view_widget.render_widget.layer.dataProvider(), 1)
-                ce = QgsContrastEnhancement(view_widget.render_widget.layer.dataProvider().dataType(0))
-                ce.setContrastEnhancementAlgorithm(QgsContrastEnhancement.StretchToMinimumMaximum)
-                ce.setMinimumValue(mean - 5 * std)
-                ce.setMaximumValue(mean + 5 * std)
-                renderer.setContrastEnhancement(ce)
-                view_widget.render_widget.layer.setRenderer(renderer)
-                # release GDAL handle (assigning None is the canonical close idiom)
-                src_ds = None
-                del ds
+                self.set_pc_style(view_widget, nodata)
+
+    def set_pc_style(self, view_widget, nodata):
+        """Grey style using mean+-5*std for the principal component of the view"""
+        mean_std = self.component_mean_std(get_file_path_of_layer(view_widget.render_widget.layer), nodata)
+        if mean_std is None:
+            return
+        mean, std = mean_std
+        renderer = QgsSingleBandGrayRenderer(view_widget.render_widget.layer.dataProvider(), 1)
+        ce = QgsContrastEnhancement(view_widget.render_widget.layer.dataProvider().dataType(0))
+        ce.setContrastEnhancementAlgorithm(QgsContrastEnhancement.StretchToMinimumMaximum)
+        ce.setMinimumValue(mean - 5 * std)
+        ce.setMaximumValue(mean + 5 * std)
+        renderer.setContrastEnhancement(ce)
+        view_widget.render_widget.layer.setRenderer(renderer)
+
+    def publish_components(self, n_threads, block_size):
+        """Write the virtual components of the set opened in the background,
+        PC1 first, the views show the virtual components (projected only for
+        the tiles rendered) until each one is replaced by its GeoTIFF
+        """
+        pca_files = [get_file_path_of_layer(layer) for layer in self.pca_layers]
+        if not any(virtual_component(pca_file) is not None for pca_file in pca_files):
+            return
+        self.publish_task = PublishComponentsTask(pca_files, n_threads, block_size)
+        self.publish_task.published.connect(self.component_published)
+        self.publish_task.taskCompleted.connect(self.components_published)
+        self.publish_task.taskTerminated.connect(self.components_published)
+        QgsApplication.taskManager().addTask(self.publish_task)
+        self.MsgBar.pushMessage(
+            "The components are shown while they are written, one at a time", level=Qgis.MessageLevel.Info
+        )
+
+    def cancel_publish_components(self):
+        """Stop the publication of the components, after the one being written"""
+        if self.publish_task is not None:
+            self.publish_task.published.disconnect()
+            self.publish_task.taskCompleted.disconnect()
+            self.publish_task.taskTerminated.disconnect()
+            self.publish_task.cancel()
+            self.publish_task = None
+
+    @pyqtSlot(int, str)
+    def component_published(self, idx, pc_file):
+        """Replace the virtual component idx of the first set by its GeoTIFF"""
+        layers = next(iter(self.component_sets.values()))["layers"] if self.component_sets else self.pca_layers
+        virtual_layer = layers[idx]
+        if get_file_path_of_layer(virtual_layer) == Path(os.path.realpath(pc_file)):
+            return
+        pc_layer = load_layer(pc_file, name=virtual_layer.name(), add_to_legend=False)
+        layers[idx] = pc_layer
+        all_pca_layers = [layer for c_set in self.component_sets.values() for layer in c_set["layers"] or []]
+        if layers is not self.pca_layers:
+            return
+        for view_widget in MainAnalysisDialog.view_widgets:
+            if view_widget.pc_id is None:
+                view_widget.QCBox_RenderFile.setExceptedLayerList(all_pca_layers or self.pca_layers)
+            # the analysis opened keeps its layer, it already uses the same GeoTIFF
+            elif view_widget.pc_id == idx + 1 and view_widget.component_analysis_dialog is None:
+                with block_signals_to(view_widget.QCBox_RenderFile):
+                    view_widget.QCBox_RenderFile.setLayer(pc_layer)
+                view_widget.set_render_layer(pc_layer)
+                self.set_pc_style(view_widget, MainAnalysisDialog.nodata)
+
+    @pyqtSlot()
+    def components_published(self):
+        if self.publish_task is None:
+            return
+        if self.publish_task.error is not None:
+            self.MsgBar.pushMessage(
+                f"Error writing the components, they are still computed on demand: {self.publish_task.error}",
+                level=Qgis.MessageLevel.Warning,
+            )
+        else:
+            self.MsgBar.pushMessage("All the components were written", level=Qgis.MessageLevel.Success)
+        self.publish_task = None
+
+    @pyqtSlot(str)
+    @wait_process
+    def switch_component_set(self, set_name):
+        """Show the components of other set (estimator matrix or period) in the views"""
+        component_set = self.component_sets[set_name]
+        if component_set["layers"] is None:
+            component_set["layers"] = [
+                load_layer(pca_file, add_to_legend=False) for pca_file in component_set["stats"]["pca_files"]
+            ]
+        self.pca_layers = component_set["layers"]
+        MainAnalysisDialog.pca_layers = component_set["layers"]
+        MainAnalysisDialog.pca_stats = component_set["stats"]
+        self.set_save_transform_option()
+        all_pca_layers = [layer for c_set in self.component_sets.values() for layer in c_set["layers"] or []]
+
+        for view_widget in MainAnalysisDialog.view_widgets:
+            if view_widget.pc_id is None:
+                view_widget.QCBox_RenderFile.setExceptedLayerList(all_pca_layers)
+                continue
+            # the change detection of the previous component does not apply to the new one
+            if view_widget.component_analysis_dialog is not None:
+                view_widget.component_analysis_dialog.clean()
+                view_widget.component_analysis_dialog.deleteLater()
+                view_widget.component_analysis_dialog = None
+                view_widget.QPBtn_ComponentAnalysisDialog.setText("Change detection layer")
+            view_widget.render_widget.detection_layer = None
+            with block_signals_to(view_widget.EnableChangeDetection):
+                view_widget.EnableChangeDetection.setChecked(False)
+            # the single-date sets can have less components than the views
+            if view_widget.pc_id > len(self.pca_layers):
+                view_widget.disable()
+                view_widget.WidgetDetectionLayer.setEnabled(False)
+                continue
+            pc_layer = self.pca_layers[view_widget.pc_id - 1]
+            with block_signals_to(view_widget.QCBox_RenderFile):
+                view_widget.QCBox_RenderFile.setLayer(pc_layer)
+            view_widget.WidgetDetectionLayer.setEnabled(True)
+            view_widget.set_render_layer(pc_layer)
+
+        # the info dialog shows the statistics of the set opened
+        if self._pca_info_dialog is not None:
+            self._pca_info_dialog.close()
+        self.update_pc_style(MainAnalysisDialog.nodata)
+        self.MsgBar.pushMessage(f"Showing the principal components: {set_name}", level=Qgis.MessageLevel.Info)
 
     @pyqtSlot()
     def save_pca(self):
@@ -277,6 +461,16 @@ class MainAnalysisDialog(QDialog, FORM_CLASS):
             translate_opts = gdal.TranslateOptions(format="GTiff", noData=nodata_val)
             gdal.Translate(str(file_out), vrt, options=translate_opts)
             vrt = None
+            # keep the scale of the scaled (Int16) components
+            out_ds = gdal.Open(str(file_out), gdal.GA_Update)
+            for band_number, input_file in enumerate(input_files, start=1):
+                src_ds = gdal.Open(input_file, gdal.GA_ReadOnly)
+                src_band = src_ds.GetRasterBand(1)
+                if src_band.GetScale() not in [None, 1] or src_band.GetOffset() not in [None, 0]:
+                    out_ds.GetRasterBand(band_number).SetScale(src_band.GetScale())
+                    out_ds.GetRasterBand(band_number).SetOffset(src_band.GetOffset())
+                src_ds = None
+            out_ds = None
 
             self.MsgBar.pushMessage(
                 f'PCA stack saved successfully: "{os.path.basename(file_out)}"', level=Qgis.MessageLevel.Success
@@ -285,6 +479,93 @@ class MainAnalysisDialog(QDialog, FORM_CLASS):
         if file_out != "":
             save()
 
+    def set_save_transform_option(self):
+        pca_stats = MainAnalysisDialog.pca_stats
+        self.SaveTransform.setEnabled(pca_stats is not None and pca_stats.get("band_mean") is not None)
+        if not self.SaveTransform.isEnabled():
+            self.SaveTransform.setToolTip("Only available for the components computed with the NumPy engine")
+        self.OtherComponents.setEnabled(
+            self.layer_a is not None and self.SaveTransform.isEnabled() and "all_eigenvectors" in pca_stats
+        )
+        if not self.OtherComponents.isEnabled():
+            self.OtherComponents.setToolTip(
+                "Only available for the components computed with the NumPy engine from the input layers"
+            )
+
+    @pyqtSlot()
+    def save_transform(self):
+        pca_stats = MainAnalysisDialog.pca_stats
+        # suggested filename
+        suggested_filename = ""
+        if self.layer_a is not None:
+            suggested_filename = os.path.splitext(get_file_path_of_layer(self.layer_a))[0] + "_pca_transform.json"
+        # filesave dialog
+        file_out, _ = QFileDialog.getSaveFileName(
+            self,
+            self.tr("Save the transform of the PCA"),
+            suggested_filename,
+            self.tr("PCA transform files (*.json);;All files (*.*)"),
+        )
+        if file_out != "":
+            save_transform(pca_stats, file_out)
+            self.MsgBar.pushMessage(
+                f'PCA transform saved successfully: "{os.path.basename(file_out)}"', level=Qgis.MessageLevel.Success
+            )
+
+    @pyqtSlot()
+    def other_components(self):
+        """Compute other components (e.g. the ones left out by the automatic
+        number of components) with the transform of the PCA and load them"""
+        pca_stats = MainAnalysisDialog.pca_stats
+        n_all_pc = np.shape(pca_stats["all_eigenvectors"])[1]
+        n_pc = np.shape(pca_stats["eigenvectors"])[1]
+        text, ok = QInputDialog.getText(
+            self,
+            self.tr("Other principal components"),
+            self.tr(f"Components to compute, between 1 and {n_all_pc} (separated by commas):"),
+            text=", ".join(str(pc_id) for pc_id in range(n_pc + 1, n_all_pc + 1)),
+        )
+        if not ok or not text.strip():
+            return
+        try:
+            components = sorted({int(pc_id) for pc_id in text.replace(",", " ").split()})
+        except ValueError:
+            components = []
+        if not components or components[0] < 1 or components[-1] > n_all_pc:
+            self.MsgBar.pushMessage(
+                f"The components must be numbers between 1 and {n_all_pc}", level=Qgis.MessageLevel.Warning
+            )
+            return
+
+        @wait_process
+        def compute():
+            from pca4cd.pca4cd import PCA4CD as pca4cd
+
+            out_dir = Path(tempfile.mkdtemp(dir=pca4cd.tmp_dir))
+            transform_file = out_dir / "pca_transform.json"
+            save_transform(pca_stats, transform_file)
+            pca_files, _ = apply_transform(
+                get_file_path_of_layer(self.layer_a),
+                get_file_path_of_layer(self.layer_b),
+                transform_file,
+                out_dir,
+                pca4cd.dialog.nThreads.value(),
+                pca4cd.dialog.BlockSize.value(),
+                MainAnalysisDialog.nodata,
+                band_list=pca4cd.dialog.selected_bands(),
+                precision=pca4cd.dialog.QCBox_OutputPrecision.currentText(),
+                components=components,
+            )
+            # in the legend, to render them in the auxiliary views or use them in QGIS
+            for pca_file in pca_files:
+                load_layer(pca_file, add_to_legend=True)
+            self.MsgBar.pushMessage(
+                f"Principal components {', '.join(map(str, components))} computed and loaded in QGIS",
+                level=Qgis.MessageLevel.Success,
+            )
+
+        compute()
+
     @pyqtSlot()
     def show_pca_info(self):
         """Open (or raise) a modeless dialog with eigenvalues and eigenvectors."""
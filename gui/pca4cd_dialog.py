@@ -25,16 +25,24 @@ from multiprocessing import cpu_count
 from pathlib import Path
 
 from osgeo import gdal
-from qgis.core import Qgis, QgsMapLayerProxyModel
+from qgis.core import Qgis, QgsApplication, QgsMapLayerProxyModel
 from qgis.PyQt import uic
 from qgis.PyQt.QtCore import Qt, pyqtSignal, pyqtSlot
 from qgis.PyQt.QtWidgets import QDialog, QFileDialog, QMessageBox
 
-from pca4cd.core.pca_dask_gdal import pca
+from pca4cd.core.band_math import parse_band_math
+from pca4cd.core.block_io import DERIVED_INPUTS, OUTPUT_PRECISIONS
+from pca4cd.core.dask_cluster import cluster_available, dashboard_link
+from pca4cd.core.engines import available_engines, get_pca_engine
+from pca4cd.core.gdal_profile import GDAL_PROFILES
+from pca4cd.core.local_pca import local_pca
+from pca4cd.core.mad import IMAD_MAX_ITERATIONS, mad
+from pca4cd.core.moments import COMPONENT_RULES
+from pca4cd.core.transform import apply_transform
 from pca4cd.gui.about_dialog import AboutDialog
 from pca4cd.gui.main_analysis_dialog import MainAnalysisDialog
 from pca4cd.utils.qgis_utils import get_file_path_of_layer, load_and_select_filepath_in, load_layer
-from pca4cd.utils.system_utils import error_handler, wait_process
+from pca4cd.utils.system_utils import block_signals_to, error_handler, get_physical_memory, wait_process
 
 # plugin path
 plugin_folder = os.path.dirname(os.path.dirname(__file__))
@@ -72,7 +80,6 @@ class PCA4CDDialog(QDialog, FORM_CLASS):
 
     def check_dependencies(self):
         try:
-            import dask  # noqa: F401
             import pyqtgraph  # noqa: F401
         except ImportError:
             self.MsgBar.pushMessage("Error: missing dependencies.", level=Qgis.MessageLevel.Critical)
@@ -103,7 +110,7 @@ class PCA4CDDialog(QDialog, FORM_CLASS):
                 file_filters=self.tr("Raster files (*.tif *.img);;All files (*.*)"),
             )
         )
-        self.QCBox_InputData_A.currentIndexChanged.connect(self.set_number_of_components)
+        self.QCBox_InputData_A.currentIndexChanged.connect(self.set_bands)
         self.QCBox_InputData_A.currentIndexChanged.connect(self.set_nodata_value_in_computePC)
         self.EnableInputData_A.toggled.connect(lambda: self.EnableInputData_A.setChecked(True))
         # B
@@ -118,20 +125,123 @@ class PCA4CDDialog(QDialog, FORM_CLASS):
                 file_filters=self.tr("Raster files (*.tif *.img);;All files (*.*)"),
             )
         )
-        self.QCBox_InputData_B.currentIndexChanged.connect(self.set_number_of_components)
+        self.QCBox_InputData_B.currentIndexChanged.connect(self.set_bands)
+        self.QCBox_InputData_B.currentIndexChanged.connect(self.set_period_pcas_option)
+        self.QCBox_InputData_A.currentIndexChanged.connect(self.set_input_mode_option)
+        self.QCBox_InputData_B.currentIndexChanged.connect(self.set_input_mode_option)
         self.EnableInputData_B.toggled.connect(lambda: self.QCBox_InputData_B.setCurrentIndex(-1))
 
         # ######### Principal Components ######### #
+        self.QCBox_Method.currentTextChanged.connect(self.set_method_options)
+        self.QCBox_Bands.checkedItemsChanged.connect(self.set_input_mode_option)
+        # optional weight raster
+        self.QCBox_Weights.setFilters(QgsMapLayerProxyModel.Filter.RasterLayer)
+        self.QCBox_Weights.setAllowEmptyLayer(True)
+        self.QCBox_Weights.setLayer(None)
+        self.QCBox_InputMode.addItems(["Stack", *DERIVED_INPUTS])
+        self.QCBox_InputMode.currentTextChanged.connect(self.set_number_of_components)
+        self.QCBox_InputMode.currentTextChanged.connect(self.set_period_pcas_option)
+        self.BandMath.editingFinished.connect(self.set_number_of_components)
         self.QPBtn_runPCA.clicked.connect(self.generate_principal_components)
         # process settings
         self.group_ProcessSettings.setVisible(False)
         self.nThreads.setValue(cpu_count())
+        self.QCBox_GDALProfile.addItems(list(GDAL_PROFILES))
+        self.QCBox_OutputPrecision.addItems(list(OUTPUT_PRECISIONS))
+        self.QCBox_Engine.currentTextChanged.connect(self.set_engine_options)
+        self.QCBox_Engine.addItems(available_engines())
+        self.DaskCluster.toggled.connect(lambda: self.set_engine_options(self.QCBox_Engine.currentText()))
+        self.DaskDashboard.clicked.connect(self.open_dask_dashboard)
+        # use by default the half of the physical memory
+        physical_memory = get_physical_memory()
+        if physical_memory:
+            self.MemoryBudget.setValue(max(physical_memory // 2, self.MemoryBudget.minimum()))
 
         # ######### Load External Principal Components ######### #
         self.QgsFile_LoadStackPCA.fileChanged.connect(self.set_nodata_value_in_loadPC)
         # load
         self.QPBtn_LoadStackPCA.clicked.connect(self.load_external_pc_in_main_analysis_dialog)
 
+    @pyqtSlot(str)
+    def set_engine_options(self, engine):
+        method = self.QCBox_Method.currentText()
+        # the options of the block pipeline, used by all the methods except the PCA of the Dask engine
+        block_pipeline = method != "PCA" or engine == "NumPy"
+        for widget in [self.QCBox_GDALProfile, self.StagingCache]:
+            widget.setEnabled(block_pipeline)
+        # the local cluster of the Dask engine, its workers share the memory budget
+        self.DaskCluster.setEnabled(method == "PCA" and engine == "Dask" and cluster_available())
+        self.MemoryBudget.setEnabled(block_pipeline or (self.DaskCluster.isEnabled() and self.DaskCluster.isChecked()))
+        self.DaskDashboard.setEnabled(dashboard_link() is not None)
+        # the MAD outputs are always Float32
+        self.QCBox_OutputPrecision.setEnabled((block_pipeline or engine == "Jobs") and method not in ["MAD", "iMAD"])
+        # the options only supported by the PCA of the NumPy engine (and the tile jobs)
+        self.BothEstimators.setEnabled(method == "PCA" and engine == "NumPy")
+        self.VirtualComponents.setEnabled(method == "PCA" and engine == "NumPy")
+        self.ProgressiveComponents.setEnabled(method == "PCA" and engine == "NumPy")
+        self.QCBox_Weights.setEnabled(method == "PCA" and engine in ["NumPy", "Jobs"])
+        self.Checkpoints.setEnabled(method == "PCA" and engine in ["NumPy", "Jobs"])
+        self.BandMath.setEnabled(method == "PCA" and engine in ["NumPy", "Jobs"])
+        self.set_input_mode_option()
+
+    @pyqtSlot()
+    def set_period_pcas_option(self):
+        # the single-date PCAs need both periods
+        self.PeriodPCAs.setEnabled(
+            self.QCBox_Method.currentText() == "PCA"
+            and self.QCBox_Engine.currentText() == "NumPy"
+            and self.QCBox_InputData_B.currentLayer() is not None
+            and self.input_mode() is None
+        )
+
+    @pyqtSlot()
+    def set_input_mode_option(self):
+        # the derived inputs need both periods with the same number of bands
+        n_bands_A, n_bands_B = self.selected_band_counts()
+        self.QCBox_InputMode.setEnabled(
+            self.QCBox_Method.currentText() == "PCA"
+            and self.QCBox_Engine.currentText() in ["NumPy", "Jobs"]
+            and self.QCBox_InputData_B.currentLayer() is not None
+            and n_bands_A == n_bands_B > 0
+        )
+        self.set_number_of_components()
+        self.set_period_pcas_option()
+
+    @pyqtSlot()
+    @error_handler
+    def open_dask_dashboard(self):
+        if dashboard_link() is not None:
+            webbrowser.open(dashboard_link())
+
+    def checkpoint_dir(self):
+        """Durable directory of the checkpoints in the QGIS profile, or None"""
+        if not self.Checkpoints.isEnabled() or not self.Checkpoints.isChecked():
+            return None
+        return Path(QgsApplication.qgisSettingsDirPath()) / "pca4cd" / "checkpoints"
+
+    def input_mode(self):
+        """Derived input selected for the PCA, or None for the stacked bands"""
+        if not self.QCBox_InputMode.isEnabled() or self.QCBox_InputMode.currentText() not in DERIVED_INPUTS:
+            return None
+        return self.QCBox_InputMode.currentText()
+
+    def band_math_expressions(self):
+        """Band-math expressions of the extra variables, or None (see parse_band_math)"""
+        if not self.BandMath.isEnabled() or not self.BandMath.text().strip():
+            return None
+        return parse_band_math(self.BandMath.text())
+
+    @pyqtSlot(str)
+    def set_method_options(self, method):
+        # the MAD outputs all its variates and does not use the estimator matrix
+        for widget in [self.QCBox_nComponents, self.QCBox_EstimatorMatrix]:
+            widget.setEnabled(method in ["PCA", "Local PCA"])
+        self.QCBox_Engine.setEnabled(method == "PCA")
+        self.TileSize.setEnabled(method == "Local PCA")
+        # the saved transform sets the components
+        self.TransformFile.setEnabled(method == "Apply transform")
+        self.set_engine_options(self.QCBox_Engine.currentText())
+
     @pyqtSlot()
     def browser_dialog_to_load_file(self, combo_box, dialog_title, file_filters):
         file_path, _ = QFileDialog.getOpenFileName(self, dialog_title, "", file_filters)
@@ -159,22 +269,59 @@ class PCA4CDDialog(QDialog, FORM_CLASS):
         src_ds = None
 
     @pyqtSlot()
-    def set_number_of_components(self):
+    def set_bands(self):
+        # all the bands of the stack A, B checked, the item data is the band number in the stack
         current_layer_A = self.QCBox_InputData_A.currentLayer()
         current_layer_B = self.QCBox_InputData_B.currentLayer()
+        with block_signals_to(self.QCBox_Bands):
+            self.QCBox_Bands.clear()
+            if current_layer_A is not None:
+                band_number = 0
+                for stack, layer in zip("AB", [current_layer_A, current_layer_B], strict=True):
+                    if layer is None:
+                        continue
+                    for band in range(1, layer.bandCount() + 1):
+                        band_number += 1
+                        label = f"{stack}·B{band}" if current_layer_B is not None else f"B{band}"
+                        self.QCBox_Bands.addItemWithCheckState(label, Qt.CheckState.Checked, band_number)
+        self.set_input_mode_option()
+
+    def selected_bands(self):
+        """Band numbers in the stack A, B checked, or None if all of them are checked"""
+        band_list = [int(band_number) for band_number in self.QCBox_Bands.checkedItemsData()]
+        if len(band_list) == self.QCBox_Bands.count():
+            return None
+        return band_list
+
+    def selected_band_counts(self):
+        """Number of bands checked of A and of B"""
+        n_bands_A = 0
+        if self.QCBox_InputData_A.currentLayer() is not None:
+            n_bands_A = self.QCBox_InputData_A.currentLayer().bandCount()
+        band_numbers = [int(band_number) for band_number in self.QCBox_Bands.checkedItemsData()]
+        n_selected_A = sum(band_number <= n_bands_A for band_number in band_numbers)
+        return n_selected_A, len(band_numbers) - n_selected_A
+
+    @pyqtSlot()
+    def set_number_of_components(self):
         self.QCBox_nComponents.clear()
 
-        number_components = 0
-        if current_layer_A is not None:
-            number_components += current_layer_A.bandCount()
-        if current_layer_B is not None:
-            number_components += current_layer_B.bandCount()
+        n_bands_A, n_bands_B = self.selected_band_counts()
+        number_components = n_bands_A
+        if self.input_mode() is None:
+            number_components += n_bands_B
+        try:
+            number_components += len(self.band_math_expressions() or {})
+        except ValueError:
+            pass
 
         if number_components != 0:
             # set number of components to combobox
             self.QCBox_nComponents.addItems([str(x) for x in range(1, number_components + 1)])
             # select the last item
             self.QCBox_nComponents.setCurrentIndex(number_components - 1)
+            # the number of components chosen from the eigenvalues
+            self.QCBox_nComponents.addItems([f"Auto: {rule}" for rule in COMPONENT_RULES])
 
     def check_input_layers(self, layer_A, layer_B):
         if layer_B is None:
@@ -215,21 +362,141 @@ class PCA4CDDialog(QDialog, FORM_CLASS):
                 self.MsgBar.pushMessage("The NoData value is not valid", level=Qgis.MessageLevel.Warning)
                 return
 
+        # check the bands selected
+        n_bands_A, n_bands_B = self.selected_band_counts()
+        if n_bands_A + n_bands_B == 0:
+            self.MsgBar.pushMessage("Select at least one band to analyze", level=Qgis.MessageLevel.Warning)
+            return
+        band_list = self.selected_bands()
+        # check the band-math expressions
+        try:
+            expressions = self.band_math_expressions()
+        except ValueError as err:
+            self.MsgBar.pushMessage(str(err), level=Qgis.MessageLevel.Warning)
+            return
+        # check the weight raster
+        layer_weights = self.QCBox_Weights.currentLayer() if self.QCBox_Weights.isEnabled() else None
+        if layer_weights is not None and (
+            layer_weights.width() != self.QCBox_InputData_A.currentLayer().width()
+            or layer_weights.height() != self.QCBox_InputData_A.currentLayer().height()
+        ):
+            self.MsgBar.pushMessage(
+                "The weight layer doesn't have the same dimensions (columns/rows) as the layers",
+                level=Qgis.MessageLevel.Warning,
+            )
+            return
+
         path_layer_A = get_file_path_of_layer(self.QCBox_InputData_A.currentLayer())
         path_layer_B = get_file_path_of_layer(self.QCBox_InputData_B.currentLayer())
-        n_pc = int(self.QCBox_nComponents.currentText())
+        n_pc = self.QCBox_nComponents.currentText()
+        n_pc = n_pc.removeprefix("Auto: ") if n_pc.startswith("Auto: ") else int(n_pc)
         estimator_matrix = self.QCBox_EstimatorMatrix.currentText()
 
-        pca_files, pca_stats = pca(
-            path_layer_A,
-            path_layer_B,
-            n_pc,
-            estimator_matrix,
-            pca4cd.tmp_dir,
-            self.nThreads.value(),
-            self.BlockSize.value(),
-            nodata,
-        )
+        method = self.QCBox_Method.currentText()
+        progressive = False
+        if method in ["MAD", "iMAD"]:
+            if self.QCBox_InputData_B.currentLayer() is None or n_bands_A != n_bands_B:
+                self.MsgBar.pushMessage(
+                    f"The {method} requires the layer B with the same number of bands selected as the layer A",
+                    level=Qgis.MessageLevel.Warning,
+                )
+                return
+            pca_files, pca_stats = mad(
+                path_layer_A,
+                path_layer_B,
+                pca4cd.tmp_dir,
+                self.nThreads.value(),
+                self.BlockSize.value(),
+                nodata,
+                max_iterations=IMAD_MAX_ITERATIONS if method == "iMAD" else 1,
+                gdal_profile=self.QCBox_GDALProfile.currentText(),
+                memory_budget=self.MemoryBudget.value(),
+                staging=self.StagingCache.isChecked(),
+                band_list=band_list,
+            )
+        elif method == "Apply transform":
+            transform_file = self.TransformFile.filePath()
+            if not transform_file or not os.path.isfile(transform_file):
+                self.MsgBar.pushMessage("Select a valid transform file", level=Qgis.MessageLevel.Warning)
+                return
+            pca_files, pca_stats = apply_transform(
+                path_layer_A,
+                path_layer_B,
+                transform_file,
+                pca4cd.tmp_dir,
+                self.nThreads.value(),
+                self.BlockSize.value(),
+                nodata,
+                gdal_profile=self.QCBox_GDALProfile.currentText(),
+                memory_budget=self.MemoryBudget.value(),
+                precision=self.QCBox_OutputPrecision.currentText(),
+                band_list=band_list,
+            )
+        elif method == "Local PCA":
+            pca_files, pca_stats = local_pca(
+                path_layer_A,
+                path_layer_B,
+                n_pc,
+                estimator_matrix,
+                pca4cd.tmp_dir,
+                self.nThreads.value(),
+                self.BlockSize.value(),
+                nodata,
+                tile_size=self.TileSize.value(),
+                gdal_profile=self.QCBox_GDALProfile.currentText(),
+                memory_budget=self.MemoryBudget.value(),
+                precision=self.QCBox_OutputPrecision.currentText(),
+                staging=self.StagingCache.isChecked(),
+                band_list=band_list,
+            )
+        else:
+            engine = self.QCBox_Engine.currentText()
+            pca = get_pca_engine(engine)
+            pca_args = (
+                path_layer_A,
+                path_layer_B,
+                n_pc,
+                estimator_matrix,
+                pca4cd.tmp_dir,
+                self.nThreads.value(),
+                self.BlockSize.value(),
+                nodata,
+            )
+            if engine == "NumPy":
+                virtual = self.VirtualComponents.isEnabled() and self.VirtualComponents.isChecked()
+                # the components are written after the analysis is opened, see publish_components
+                progressive = self.ProgressiveComponents.isEnabled() and self.ProgressiveComponents.isChecked()
+                pca_files, pca_stats = pca(
+                    *pca_args,
+                    gdal_profile=self.QCBox_GDALProfile.currentText(),
+                    memory_budget=self.MemoryBudget.value(),
+                    precision=self.QCBox_OutputPrecision.currentText(),
+                    staging=self.StagingCache.isChecked(),
+                    both_estimators=self.BothEstimators.isChecked(),
+                    period_pcas=self.PeriodPCAs.isEnabled() and self.PeriodPCAs.isChecked(),
+                    derived_input=self.input_mode(),
+                    band_list=band_list,
+                    weights=get_file_path_of_layer(layer_weights),
+                    checkpoint_dir=self.checkpoint_dir(),
+                    expressions=expressions,
+                    virtual=virtual or progressive,
+                )
+            elif engine == "Jobs":
+                pca_files, pca_stats = pca(
+                    *pca_args,
+                    precision=self.QCBox_OutputPrecision.currentText(),
+                    derived_input=self.input_mode(),
+                    band_list=band_list,
+                    weights=get_file_path_of_layer(layer_weights),
+                    checkpoint_dir=self.checkpoint_dir(),
+                    expressions=expressions,
+                )
+            else:
+                cluster = self.DaskCluster.isEnabled() and self.DaskCluster.isChecked()
+                pca_files, pca_stats = pca(
+                    *pca_args, band_list=band_list, cluster=cluster, memory_budget=self.MemoryBudget.value()
+                )
+                self.DaskDashboard.setEnabled(dashboard_link() is not None)
 
         if pca_files is False and pca_stats is False:
             self.MsgBar.pushMessage("Error calculating PCA", level=Qgis.MessageLevel.Critical, duration=10)
@@ -246,6 +513,8 @@ class PCA4CDDialog(QDialog, FORM_CLASS):
                 pca_layers.append(load_layer(pca_file, add_to_legend=False))
             # then, open main analysis dialog
             self.open_main_analysis_dialog(pca_layers, pca_stats, nodata)
+            if progressive:
+                self.main_analysis_dialog.publish_components(self.nThreads.value(), self.BlockSize.value())
         else:
             self.MsgBar.pushMessage(
                 "Error while generating the principal components; check the QGIS log", level=Qgis.MessageLevel.Critical
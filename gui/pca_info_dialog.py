@@ -40,7 +40,7 @@ from qgis.PyQt.QtWidgets import (
 
 class PCAInfoDialog(QDialog):
     """Read-only dialog showing eigenvalues, cumulative variance and the
-    eigenvector matrix produced by `core.pca_dask_gdal.pca`.
+    eigenvector matrix produced by the pca function of the engines (`core.engines`).
     """
 
     def __init__(self, pca_stats, parent=None):
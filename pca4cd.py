@@ -28,6 +28,7 @@ from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QAction
 from qgis.utils import iface
 
+from pca4cd.core.dask_cluster import close_cluster
 from pca4cd.gui.about_dialog import AboutDialog
 from pca4cd.gui.pca4cd_dialog import PCA4CDDialog
 from pca4cd.utils.qgis_utils import unload_layer
@@ -197,6 +198,8 @@ class PCA4CD:
             for file_tmp in PCA4CD.tmp_dir.glob("*"):
                 unload_layer(file_tmp)
 
+        # stop the workers of the Dask local cluster, they spill in the tmp dir
+        close_cluster()
         # clear PCA4CD.tmp_dir
         if PCA4CD.tmp_dir and os.path.isdir(PCA4CD.tmp_dir):
             shutil.rmtree(PCA4CD.tmp_dir, ignore_errors=True)